@@ -1,9 +1,18 @@
+import httplib
 import os
+import random
 import re
-import subprocess
+import socket
 import sys
 import time
 import thread
+import threading
+
+import bandwidth
+import hls
+import http_pool
+import range_map
+import supervisor
 
 from youtube_dl.utils import (
     compat_urllib_error,
@@ -44,6 +53,27 @@ class FileDownloader(object):
     test:              Download only first bytes to test the downloader.
     min_filesize:      Skip files smaller than this size
     max_filesize:      Skip files larger than this size
+    segments:          Number of byte ranges to fetch in parallel (default 1).
+    min_segment_size:  Do not split files into ranges smaller than this.
+    fastbuffersize:    Size of the reusable buffer used when the connection
+                       supports readinto (default 256 KiB).
+    progress_interval: Minimum seconds between two "downloading" progress
+                       hook calls (default 0.1).
+    progress_step:     Also call the hooks once this number of bytes were
+                       downloaded since the last call, even if
+                       progress_interval did not elapse.
+    bandwidth_class:   Priority class of the download in the bandwidth
+                       scheduler (default bandwidth.PLAYBACK).
+    socket_timeout:    Seconds to wait for data before a read fails.
+    stream_retries:    Number of times to reconnect after the connection was
+                       lost while downloading, without receiving any data in
+                       between (default 10).
+    retry_backoff:     Seconds to wait before the first reconnection, doubled
+                       for every following attempt (default 1).
+    max_retry_backoff: Maximum seconds to wait between two reconnections
+                       (default 30).
+    hls_concurrency:   Number of HLS segments fetched at the same time, and
+                       kept in memory until written in order (default 4).
     """
 
     params = None
@@ -55,6 +85,33 @@ class FileDownloader(object):
         self._progress_hooks = []
         self.params = params
 
+        # Held while the progress hooks run, so that stop_download can wait
+        # for them. Reentrant, hooks may stop the download themselves
+        self._hook_lock = threading.RLock()
+        # Last status given to the progress hooks, to coalesce updates
+        self._last_hook_status = None
+        self._last_hook_time = 0
+        self._last_hook_bytes = 0
+
+        # Responses being read, closed by stop_download
+        self._responses = []
+        # External programs being run, stopped by stop_download
+        self._processes = []
+        # Ranges of the segmented download running, and how to start a
+        # connection for one of them
+        self._range_scheduler = None
+        self._start_fetch = None
+        self._stopped = threading.Event()
+        # Reconnections after the connection was lost, and the seconds it cost
+        self._reconnects = 0
+        self._lost_time = 0.0
+        # Where the connection of the current thread was lost last, and the
+        # attempts made to reconnect from there
+        self._stall = threading.local()
+        # Cleared while a download or a prefetch runs
+        self._idle = threading.Event()
+        self._idle.set()
+
         self._go_on = True
 
     @staticmethod
@@ -284,83 +341,42 @@ class FileDownloader(object):
     def _download_with_rtmpdump(self, filename, url, player_url, page_url, play_path, tc_url, live, conn):
         def run_rtmpdump(args):
             start = time.time()
-            resume_percent = None
-            resume_downloaded_data_len = None
-            proc = subprocess.Popen(args, stderr=subprocess.PIPE)
-            cursor_in_new_line = True
-            proc_stderr_closed = False
-            while not proc_stderr_closed:
-                # read line from stderr
-                line = u''
-                while True:
-                    char = proc.stderr.read(1)
-                    if not char:
-                        proc_stderr_closed = True
-                        break
-                    if char in [b'\r', b'\n']:
-                        break
-                    line += char.decode('ascii', 'replace')
-                if not line:
-                    # proc_stderr_closed is True
-                    continue
+            resume = {}
+
+            def parse_line(line):
                 mobj = re.search(r'([0-9]+\.[0-9]{3}) kB / [0-9]+\.[0-9]{2} sec \(([0-9]{1,2}\.[0-9])%\)', line)
                 if mobj:
                     downloaded_data_len = int(float(mobj.group(1))*1024)
                     percent = float(mobj.group(2))
-                    if not resume_percent:
-                        resume_percent = percent
-                        resume_downloaded_data_len = downloaded_data_len
-                    eta = self.calc_eta(start, time.time(), 100-resume_percent, percent-resume_percent)
-                    speed = self.calc_speed(start, time.time(), downloaded_data_len-resume_downloaded_data_len)
+                    if not resume:
+                        resume['percent'] = percent
+                        resume['downloaded_data_len'] = downloaded_data_len
+                    eta = self.calc_eta(start, time.time(), 100-resume['percent'], percent-resume['percent'])
+                    speed = self.calc_speed(start, time.time(), downloaded_data_len-resume['downloaded_data_len'])
                     data_len = None
                     if percent > 0:
                         data_len = int(downloaded_data_len * 100 / percent)
                     data_len_str = u'~' + format_bytes(data_len)
                     self.report_progress(percent, data_len_str, speed, eta)
-                    cursor_in_new_line = False
-                    self._hook_progress({
-                        'downloaded_bytes': downloaded_data_len,
-                        'total_bytes': data_len,
-                        'tmpfilename': tmpfilename,
-                        'filename': filename,
-                        'status': 'downloading',
-                        'eta': eta,
-                        'speed': speed,
-                    })
-                else:
-                    # no percent for live streams
-                    mobj = re.search(r'([0-9]+\.[0-9]{3}) kB / [0-9]+\.[0-9]{2} sec', line)
-                    if mobj:
-                        downloaded_data_len = int(float(mobj.group(1))*1024)
-                        time_now = time.time()
-                        speed = self.calc_speed(start, time_now, downloaded_data_len)
-                        self.report_progress_live_stream(downloaded_data_len, speed, time_now - start)
-                        cursor_in_new_line = False
-                        self._hook_progress({
-                            'downloaded_bytes': downloaded_data_len,
-                            'tmpfilename': tmpfilename,
-                            'filename': filename,
-                            'status': 'downloading',
-                            'speed': speed,
-                        })
-                    elif self.params.get('verbose', False):
-                        if not cursor_in_new_line:
-                            self.to_screen(u'')
-                        cursor_in_new_line = True
-                        self.to_screen(u'[rtmpdump] '+line)
-            proc.wait()
-            if not cursor_in_new_line:
-                self.to_screen(u'')
-            return proc.returncode
+                    return {'total_bytes': data_len, 'eta': eta}
+                # no percent for live streams
+                mobj = re.search(r'([0-9]+\.[0-9]{3}) kB / [0-9]+\.[0-9]{2} sec', line)
+                if mobj:
+                    downloaded_data_len = int(float(mobj.group(1))*1024)
+                    time_now = time.time()
+                    speed = self.calc_speed(start, time_now, downloaded_data_len)
+                    self.report_progress_live_stream(downloaded_data_len, speed, time_now - start)
+                    return {}
+                return None
+
+            return self._run_process(args, tmpfilename, filename, parse_line)
 
         self.report_destination(filename)
         tmpfilename = self.temp_name(filename)
         test = self.params.get('test', False)
 
         # Check for rtmpdump first
-        try:
-            subprocess.call(['rtmpdump', '-h'], stdout=(open(os.path.devnull, 'w')), stderr=subprocess.STDOUT)
-        except (OSError, IOError):
+        if supervisor.find_program('rtmpdump') is None:
             self.report_error(u'RTMP download detected but "rtmpdump" could not be run')
             return False
 
@@ -412,8 +428,10 @@ class FileDownloader(object):
         while (retval == 2 or retval == 1) and not test:
             prevsize = os.path.getsize(encodeFilename(tmpfilename))
             self.to_screen(u'[rtmpdump] %s bytes' % prevsize)
-            time.sleep(5.0) # This seems to be needed
+            self._stopped.wait(5.0) # This seems to be needed
             retval = run_rtmpdump(basic_args + ['-e'] + [[], ['-k', '1']][retval == 1])
+            if retval is None:
+                return False
             cursize = os.path.getsize(encodeFilename(tmpfilename))
             if prevsize == cursize and retval == 1:
                 break
@@ -422,6 +440,8 @@ class FileDownloader(object):
                 self.to_screen(u'[rtmpdump] Could not download the whole video. This can happen for some advertisements.')
                 retval = 0
                 break
+        if retval is None:
+            return False
         if retval == 0 or (test and retval == 2):
             fsize = os.path.getsize(encodeFilename(tmpfilename))
             self.to_screen(u'[rtmpdump] %s bytes' % fsize)
@@ -444,14 +464,14 @@ class FileDownloader(object):
 
         args = ['mplayer', '-really-quiet', '-vo', 'null', '-vc', 'dummy', '-dumpstream', '-dumpfile', tmpfilename, url]
         # Check for mplayer first
-        try:
-            subprocess.call(['mplayer', '-h'], stdout=(open(os.path.devnull, 'w')), stderr=subprocess.STDOUT)
-        except (OSError, IOError):
+        if supervisor.find_program('mplayer') is None:
             self.report_error(u'MMS or RTSP download detected but "%s" could not be run' % args[0] )
             return False
 
         # Download using mplayer. 
-        retval = subprocess.call(args)
+        retval = self._run_process(args, tmpfilename, filename)
+        if retval is None:
+            return False
         if retval == 0:
             fsize = os.path.getsize(encodeFilename(tmpfilename))
             self.to_screen(u'\r[%s] %s bytes' % (args[0], fsize))
@@ -475,17 +495,15 @@ class FileDownloader(object):
         args = ['-y', '-i', url, '-f', 'mp4', '-c', 'copy',
             '-bsf:a', 'aac_adtstoasc', tmpfilename]
 
-        for program in ['avconv', 'ffmpeg']:
-            try:
-                subprocess.call([program, '-version'], stdout=(open(os.path.devnull, 'w')), stderr=subprocess.STDOUT)
-                break
-            except (OSError, IOError):
-                pass
-        else:
+        program = self._find_ffmpeg()
+        if program is None:
             self.report_error(u'm3u8 download detected but ffmpeg or avconv could not be found')
+            return False
         cmd = [program] + args
 
-        retval = subprocess.call(cmd)
+        retval = self._run_process(cmd, tmpfilename, filename)
+        if retval is None:
+            return False
         if retval == 0:
             fsize = os.path.getsize(encodeFilename(tmpfilename))
             self.to_screen(u'\r[%s] %s bytes' % (args[0], fsize))
@@ -502,9 +520,317 @@ class FileDownloader(object):
             self.report_error(u'ffmpeg exited with code %d' % retval)
             return False
 
+    def _find_ffmpeg(self):
+        return supervisor.find_program('avconv', 'ffmpeg')
+
+    def _run_process(self, args, tmpfilename, filename, parse_line=None):
+        """Run an external downloader writing to tmpfilename.
+
+        Progress hooks are called as tmpfilename grows, with the keys of
+        the dict parse_line(line) returns for a line of its stderr, lines
+        it returns None for are shown in verbose mode. No hook is called
+        if tmpfilename is None. stop_download terminates the program.
+
+        Returns its exit code, or None if it was stopped or could not be
+        started.
+        """
+        name = os.path.basename(args[0])
+        process = supervisor.SupervisedProcess(args)
+        self.lock.acquire()
+        try:
+            if not self._go_on:
+                return None
+            process.start()
+            self._processes.append(process)
+        except OSError as err:
+            self.report_error(u'%s could not be run: %s' % (name, err))
+            return None
+        finally:
+            self.lock.release()
+
+        start = time.time()
+        try:
+            initial_size = os.path.getsize(encodeFilename(tmpfilename)) if tmpfilename else 0
+        except OSError:
+            initial_size = 0
+        parsed = {}
+        last_size = None
+        interval = self.params.get('progress_interval', 0.1)
+        try:
+            while True:
+                exited = process.wait(interval)
+                for line in process.readLines():
+                    fields = parse_line(line) if parse_line is not None else None
+                    if fields is not None:
+                        parsed.update(fields)
+                    elif self.params.get('verbose', False):
+                        self.to_screen(u'[%s] %s' % (name, line))
+                if exited:
+                    break
+                if tmpfilename is None:
+                    continue
+                try:
+                    size = os.path.getsize(encodeFilename(tmpfilename))
+                except OSError:
+                    # Not created yet
+                    continue
+                if size == last_size:
+                    continue
+                last_size = size
+                status = {
+                    'downloaded_bytes': size,
+                    'contiguous_bytes': size,
+                    'tmpfilename': tmpfilename,
+                    'filename': filename,
+                    'status': 'downloading',
+                    'speed': self.calc_speed(start, time.time(), size - initial_size),
+                }
+                status.update(parsed)
+                self._hook_progress(status)
+        finally:
+            self.lock.acquire()
+            if process in self._processes:
+                self._processes.remove(process)
+            self.lock.release()
+
+        if process.isStopped():
+            return None
+        return process.returncode
+
+    def _download_hls(self, filename, url):
+        """Download a HLS stream without external programs.
+
+        Segments are fetched hls_concurrency at a time, and appended in
+        order to the temporary file, which can be played while it grows.
+        The number of segments written is kept next to it so that an
+        interrupted download resumes from the last complete segment.
+        MPEG-TS streams are remuxed to MP4 at the end if filename asks for
+        it and ffmpeg or avconv is available.
+        """
+        playlist = self._fetch_playlist(url)
+        if playlist.variants:
+            url = playlist.getBestVariant()
+            playlist = self._fetch_playlist(url)
+        if not playlist.supported or not playlist.ended or not playlist.segments:
+            # Encrypted, split in byte ranges or live
+            return self._download_m3u8_with_ffmpeg(filename, url)
+
+        tmpfilename = self.temp_name(filename)
+        state_filename = tmpfilename + '.hls'
+        segments = playlist.segments
+        segment_count = len(segments)
+
+        written = 0
+        byte_counter = 0
+        if self.params.get('continuedl', False) and os.path.isfile(encodeFilename(tmpfilename)):
+            try:
+                with open(encodeFilename(state_filename)) as state:
+                    written, byte_counter = [int(value) for value in state.read().split()]
+            except (IOError, ValueError):
+                written = byte_counter = 0
+            if written > segment_count or byte_counter > os.path.getsize(encodeFilename(tmpfilename)):
+                written = byte_counter = 0
+            if written:
+                self.report_resuming_byte(byte_counter)
+        try:
+            stream = open(encodeFilename(tmpfilename), 'r+b' if written else 'wb')
+            stream.seek(byte_counter)
+            stream.truncate()
+        except (OSError, IOError) as err:
+            self.report_error(u'unable to open for writing: %s' % str(err))
+            return False
+        self.report_destination(filename)
+
+        window = self.params.get('hls_concurrency', 4)
+        cond = threading.Condition()
+        # index -> data or the exception raised while fetching the segment
+        fetched = {}
+        scheduled = [written]
+        written_segments = [written]
+        stopped = [False]
+
+        klass = bandwidth.get_thread_class()
+
+        def fetch():
+            bandwidth.set_thread_class(klass)
+            while True:
+                cond.acquire()
+                # Do not get further than window segments ahead of the writer
+                while self._go_on and not stopped[0] and scheduled[0] < segment_count and \
+                        scheduled[0] >= written_segments[0] + window:
+                    cond.wait(0.5)
+                if not self._go_on or stopped[0] or scheduled[0] >= segment_count:
+                    cond.release()
+                    return
+                index = scheduled[0]
+                scheduled[0] += 1
+                cond.release()
+
+                try:
+                    data = self._fetch_segment(segments[index].url)
+                except Exception as err:
+                    data = err
+                cond.acquire()
+                fetched[index] = data
+                cond.notify_all()
+                cond.release()
+
+        workers = []
+        for unused_i in range(min(window, segment_count - written)):
+            worker = threading.Thread(target=fetch)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        start = time.time()
+        resume_len = byte_counter
+        error = None
+        try:
+            while written < segment_count and self._go_on:
+                cond.acquire()
+                while self._go_on and written not in fetched:
+                    cond.wait(0.5)
+                data = fetched.pop(written, None)
+                cond.release()
+                if data is None:
+                    break
+                if isinstance(data, Exception):
+                    error = data
+                    break
+
+                stream.write(data)
+                stream.flush()
+                byte_counter += len(data)
+                written += 1
+                cond.acquire()
+                written_segments[0] = written
+                cond.notify_all()
+                cond.release()
+                with open(encodeFilename(state_filename), 'w') as state:
+                    state.write('%d %d' % (written, byte_counter))
+
+                # The size of the segments left is not known, assume they look alike
+                total_bytes = byte_counter * segment_count // written
+                speed = self.calc_speed(start, time.time(), byte_counter - resume_len)
+                eta = self.calc_eta(start, time.time(), total_bytes - resume_len, byte_counter - resume_len)
+                self.report_progress(self.calc_percent(byte_counter, total_bytes),
+                                     format_bytes(total_bytes), speed, eta)
+                self._hook_progress({
+                    'downloaded_bytes': byte_counter,
+                    'contiguous_bytes': byte_counter,
+                    'total_bytes': total_bytes,
+                    'segment_index': written,
+                    'segment_count': segment_count,
+                    'tmpfilename': tmpfilename,
+                    'filename': filename,
+                    'status': 'downloading',
+                    'eta': eta,
+                    'speed': speed,
+                })
+        finally:
+            stream.close()
+            cond.acquire()
+            stopped[0] = True
+            cond.notify_all()
+            cond.release()
+
+        if error is not None:
+            self.to_stderr(u"\n")
+            self.report_error(u'unable to download segment %d: %s' % (written + 1, str(error)))
+            return False
+        if written < segment_count:
+            return False
+        self.report_finish(format_bytes(byte_counter), (time.time() - start))
+
+        if not playlist.fragmented_mp4 and determine_ext(filename) in (u'mp4', u'm4a'):
+            byte_counter = self._remux_hls(tmpfilename, filename) or byte_counter
+            if self.is_stopped():
+                # Every segment is kept, the next attempt only remuxes them
+                return False
+        self.try_rename(tmpfilename, filename)
+        try:
+            os.remove(encodeFilename(state_filename))
+        except OSError:
+            pass
+        self._hook_progress({
+            'downloaded_bytes': byte_counter,
+            'total_bytes': byte_counter,
+            'filename': filename,
+            'status': 'finished',
+        })
+        return True
+
+    def _fetch_playlist(self, url):
+        data = self._urlopen(compat_urllib_request.Request(url))
+        try:
+            return hls.parse_playlist(data.read().decode('utf-8'), data.geturl())
+        finally:
+            data.close()
+
+    def _fetch_segment(self, url):
+        """Return the content of a HLS segment, reconnecting if needed."""
+        headers = {'Youtubedl-no-compression': 'True'}
+        data = self._urlopen(compat_urllib_request.Request(url, None, headers))
+        try:
+            while True:
+                if data is None:
+                    data = self._reconnect(url, headers, 0, None, error)
+                    if data is None:
+                        raise error
+                try:
+                    content = data.read()
+                except (socket.error, httplib.HTTPException) as err:
+                    content = None
+                    error = err
+                length = data.info().get('Content-length')
+                if content is not None and (length is None or len(content) == int(length)):
+                    return content
+                if content is not None:
+                    error = ContentTooShortError(len(content), int(length))
+                data.close()
+                data = None
+        finally:
+            if data is not None:
+                data.close()
+
+    def _remux_hls(self, tmpfilename, filename):
+        """Remux the MPEG-TS tmpfilename in place to the container of
+        filename, returns its new size or None if it was left as is."""
+        program = self._find_ffmpeg()
+        if program is None:
+            self.report_warning(u'ffmpeg or avconv not found, keeping the MPEG-TS stream as is')
+            return None
+        remuxed = tmpfilename + '.remux'
+        args = [program, '-y', '-loglevel', 'error', '-i', tmpfilename, '-c', 'copy',
+                '-bsf:a', 'aac_adtstoasc', '-f', 'mp4', remuxed]
+        retval = self._run_process(args, None, filename)
+        if retval is None:
+            if os.path.exists(remuxed):
+                os.remove(remuxed)
+            return None
+        if retval != 0:
+            self.report_warning(u'%s exited with code %d, keeping the MPEG-TS stream as is' % (program, retval))
+            return None
+        os.rename(remuxed, tmpfilename)
+        return os.path.getsize(encodeFilename(tmpfilename))
+
 
     def _do_download(self, filename, info_dict):
+        self._idle.clear()
+        try:
+            return self._download(filename, info_dict)
+        except Exception:
+            if self._go_on:
+                raise
+            # The connection was closed by stop_download
+            return False
+        finally:
+            self._close_responses()
+            self._idle.set()
+
+    def _download(self, filename, info_dict):
         url = info_dict['url']
+        bandwidth.set_thread_class(self.params.get('bandwidth_class', bandwidth.PLAYBACK))
 
         # Check file already present
         if self.params.get('continuedl', False) and os.path.isfile(encodeFilename(filename)) and not self.params.get('nopart', False):
@@ -530,9 +856,9 @@ class FileDownloader(object):
         if url.startswith('mms') or url.startswith('rtsp'):
             return self._download_with_mplayer(filename, url)
 
-        # m3u8 manifest are downloaded with ffmpeg
-        if determine_ext(url) == u'm3u8':
-            return self._download_m3u8_with_ffmpeg(filename, url)
+        # m3u8 manifest are downloaded natively, with ffmpeg as a fallback
+        if determine_ext(url) == u'm3u8' or info_dict.get('protocol') in ('m3u8', 'm3u8_native'):
+            return self._download_hls(filename, url)
 
         tmpfilename = self.temp_name(filename)
         stream = None
@@ -547,8 +873,13 @@ class FileDownloader(object):
         if self.params.get('test', False):
             request.add_header('Range','bytes=0-10240')
 
+        # A segmented download saves its complete ranges next to the file, whose
+        # size says nothing then
+        ranges_filename = tmpfilename + u'.ranges'
+        sparse = os.path.isfile(encodeFilename(ranges_filename)) and os.path.isfile(encodeFilename(tmpfilename))
+
         # Establish possible resume length
-        if os.path.isfile(encodeFilename(tmpfilename)):
+        if os.path.isfile(encodeFilename(tmpfilename)) and not sparse:
             resume_len = os.path.getsize(encodeFilename(tmpfilename))
         else:
             resume_len = 0
@@ -559,6 +890,14 @@ class FileDownloader(object):
                 self.report_resuming_byte(resume_len)
                 request.add_header('Range','bytes=%d-' % resume_len)
                 open_mode = 'ab'
+                # What is already there is playable, don't wait for the connection
+                self._hook_progress({
+                    'downloaded_bytes': resume_len,
+                    'total_bytes': None,
+                    'tmpfilename': tmpfilename,
+                    'filename': filename,
+                    'status': 'downloading',
+                })
             else:
                 resume_len = 0
 
@@ -569,7 +908,8 @@ class FileDownloader(object):
             try:
                 if count == 0 and 'urlhandle' in info_dict:
                     data = info_dict['urlhandle']
-                data = compat_urllib_request.urlopen(request)
+                else:
+                    data = self._urlopen(request)
                 break
             except (compat_urllib_error.HTTPError, ) as err:
                 if (err.code < 500 or err.code >= 600) and err.code != 416:
@@ -579,7 +919,7 @@ class FileDownloader(object):
                     # Unable to resume (requested range not satisfiable)
                     try:
                         # Open the connection again without the range header
-                        data = compat_urllib_request.urlopen(basic_request)
+                        data = self._urlopen(basic_request)
                         content_length = data.info()['Content-Length']
                     except (compat_urllib_error.HTTPError, ) as err:
                         if err.code < 500 or err.code >= 600:
@@ -606,6 +946,7 @@ class FileDownloader(object):
                             # The length does not match, we start the download over
                             self.report_unable_to_resume()
                             open_mode = 'wb'
+                            resume_len = 0
                             break
             # Retry
             count += 1
@@ -617,6 +958,15 @@ class FileDownloader(object):
             return False
 
         data_len = data.info().get('Content-length', None)
+        if resume_len != 0 and data.getcode() == 200:
+            # The server ignored the Range header and sends the whole file,
+            # skip what we have, it may already be getting played.
+            self.to_screen(u'[download] Server ignored Range, skipping %s bytes' % resume_len)
+            if not self._skip(data, resume_len):
+                self.report_error(u'remote file is smaller than the partial download')
+                return False
+            if data_len is not None:
+                data_len = int(data_len) - resume_len
         if data_len is not None:
             data_len = int(data_len) + resume_len
             min_data_len = self.params.get("min_filesize", None)
@@ -629,9 +979,96 @@ class FileDownloader(object):
                 return False
 
         data_len_str = format_bytes(data_len)
+
+        # Split the file in byte ranges fetched over several connections
+        segments = self.params.get('segments', 1)
+        min_segment_size = self.params.get('min_segment_size', 1048576)
+        if (segments > 1 and data_len is not None and resume_len == 0 and
+                not self.params.get('test', False) and
+                data_len >= 2 * min_segment_size):
+            segments = min(segments, data_len // min_segment_size)
+            completed = None
+            if sparse and self.params.get('continuedl', False):
+                completed = range_map.load_ranges(ranges_filename, data_len)
+            retval = self._download_segmented(data, url, headers, filename,
+                                              tmpfilename, data_len, segments, completed)
+            if retval is not None:
+                if retval and self.params.get('updatetime', True):
+                    info_dict['filetime'] = self.try_utime(filename, data.info().get('last-modified', None))
+                return retval
+        if sparse:
+            # Streamed from the start again, over what the ranges described
+            try:
+                os.remove(encodeFilename(ranges_filename))
+            except OSError:
+                pass
+
         byte_counter = 0 + resume_len
         block_size = self.params.get('buffersize', 1024)
         start = time.time()
+        while True:
+            error = None
+            if hasattr(data, 'readinto'):
+                result = self._readinto_loop(data, stream, tmpfilename, filename, open_mode,
+                                             byte_counter, resume_len, data_len, start)
+                if result is None:
+                    return False
+                (stream, tmpfilename, filename, byte_counter, error) = result
+            else:
+                try:
+                    result = self._read_loop(data, stream, tmpfilename, filename, open_mode,
+                                             byte_counter, resume_len, data_len, start, block_size)
+                except (socket.error, httplib.HTTPException) as err:
+                    result = (stream, tmpfilename, filename, byte_counter, block_size)
+                    error = err
+                if result is None:
+                    return False
+                (stream, tmpfilename, filename, byte_counter, block_size) = result
+
+            if not self._go_on or (error is None and (data_len is None or byte_counter >= data_len)):
+                break
+
+            # The connection was lost or closed early, resume where it stopped
+            data.close()
+            data = self._reconnect(url, headers, byte_counter, None, error)
+            if data is None:
+                if error is not None:
+                    raise error
+                break
+            if byte_counter and data.getcode() == 200 and not self._skip(data, byte_counter):
+                self.report_error(u'remote file is smaller than the partial download')
+                return False
+
+        if stream is None:
+            self.to_stderr(u"\n")
+            self.report_error(u'Did not get any data blocks')
+            return False
+        stream.close()
+        self.report_finish(data_len_str, (time.time() - start))
+        if data_len is not None and byte_counter != data_len:
+            raise ContentTooShortError(byte_counter, int(data_len))
+        self.try_rename(tmpfilename, filename)
+
+        # Update file modification time
+        if self.params.get('updatetime', True):
+            info_dict['filetime'] = self.try_utime(filename, data.info().get('last-modified', None))
+
+        self._hook_progress({
+            'downloaded_bytes': byte_counter,
+            'total_bytes': byte_counter,
+            'filename': filename,
+            'status': 'finished',
+        })
+        return True
+
+    def _read_loop(self, data, stream, tmpfilename, filename, open_mode,
+                   byte_counter, resume_len, data_len, start, block_size):
+        """Read data block by block, for connections without readinto.
+
+        Returns None on error, a (stream, tmpfilename, filename, byte_counter,
+        block_size) tuple otherwise, stream being None if no data was received.
+        """
+        data_len_str = format_bytes(data_len)
         while self._go_on:
             # Download and write
             before = time.time()
@@ -650,13 +1087,13 @@ class FileDownloader(object):
                     self.report_destination(filename)
                 except (OSError, IOError) as err:
                     self.report_error(u'unable to open for writing: %s' % str(err))
-                    return False
+                    return None
             try:
                 stream.write(data_block)
             except (IOError, OSError) as err:
                 self.to_stderr(u"\n")
                 self.report_error(u'unable to write data: %s' % str(err))
-                return False
+                return None
             if not self.params.get('noresizebuffer', False):
                 block_size = self.best_block_size(after - before, len(data_block))
 
@@ -682,19 +1119,430 @@ class FileDownloader(object):
             # Apply rate limit
             self.slow_down(start, byte_counter - resume_len)
 
-        if stream is None:
+        return (stream, tmpfilename, filename, byte_counter, block_size)
+
+    def prefetch(self, filename, info_dict, max_bytes):
+        """Download the first max_bytes of the media to the temporary file.
+
+        A later _do_download of filename with the continuedl option resumes
+        from where the prefetch stopped.
+        """
+        self._idle.clear()
+        try:
+            return self._prefetch(filename, info_dict, max_bytes)
+        except Exception:
+            if self._go_on:
+                raise
+            return False
+        finally:
+            self._close_responses()
+            self._idle.set()
+
+    def _prefetch(self, filename, info_dict, max_bytes):
+        url = info_dict['url']
+        bandwidth.set_thread_class(self.params.get('bandwidth_class', bandwidth.PLAYBACK))
+        tmpfilename = self.temp_name(filename)
+        if os.path.isfile(encodeFilename(filename)):
+            return True
+        if os.path.isfile(encodeFilename(tmpfilename)):
+            resume_len = os.path.getsize(encodeFilename(tmpfilename))
+        else:
+            resume_len = 0
+        if resume_len >= max_bytes:
+            return True
+
+        headers = {'Youtubedl-no-compression': 'True'}
+        if 'user_agent' in info_dict:
+            headers['Youtubedl-user-agent'] = info_dict['user_agent']
+        request = compat_urllib_request.Request(url, None, headers)
+        request.add_header('Range', 'bytes=%d-%d' % (resume_len, max_bytes - 1))
+        try:
+            data = self._urlopen(request)
+        except (compat_urllib_error.HTTPError, compat_urllib_error.URLError) as err:
+            self.report_warning(u'unable to prefetch: %s' % str(err))
+            return False
+
+        open_mode = 'ab'
+        if data.getcode() != 206:
+            open_mode = 'wb'
+            resume_len = 0
+        byte_counter = resume_len
+        start = time.time()
+        stream = None
+        try:
+            (stream, tmpfilename) = sanitize_open(tmpfilename, open_mode)
+            while self._go_on and byte_counter < max_bytes:
+                data_block = data.read(min(65536, max_bytes - byte_counter))
+                if not data_block:
+                    break
+                stream.write(data_block)
+                byte_counter += len(data_block)
+                self.slow_down(start, byte_counter - resume_len)
+        except (OSError, IOError) as err:
+            self.report_warning(u'unable to prefetch: %s' % str(err))
+            return False
+        finally:
+            if stream is not None:
+                stream.close()
+            data.close()
+        return byte_counter >= max_bytes
+
+    def _readinto_loop(self, data, stream, tmpfilename, filename, open_mode,
+                       byte_counter, resume_len, data_len, start):
+        """Read data into a preallocated buffer and write it without copies.
+
+        Speed, ETA and progress hooks are only computed every
+        progress_interval seconds instead of for every block.
+
+        Returns None on error, a (stream, tmpfilename, filename, byte_counter,
+        error) tuple otherwise, stream being None if no data was received and
+        error the exception that interrupted the connection, if any.
+        """
+        buf = bytearray(self.params.get('fastbuffersize', 262144))
+        buf_len = len(buf)
+        view = memoryview(buf)
+        readinto = data.readinto
+        interval = self.params.get('progress_interval', 0.1)
+        data_len_str = format_bytes(data_len)
+        last_report = start
+        if stream is not None:
+            write = stream.write
+        while self._go_on:
+            try:
+                read = readinto(buf)
+            except (socket.error, httplib.HTTPException) as err:
+                return (stream, tmpfilename, filename, byte_counter, err)
+            if not read:
+                break
+            byte_counter += read
+
+            # Open file just in time
+            if stream is None:
+                try:
+                    (stream, tmpfilename) = sanitize_open(tmpfilename, open_mode)
+                    assert stream is not None
+                    filename = self.undo_temp_name(tmpfilename)
+                    self.report_destination(filename)
+                except (OSError, IOError) as err:
+                    self.report_error(u'unable to open for writing: %s' % str(err))
+                    return None
+                write = stream.write
+            try:
+                if read == buf_len:
+                    write(buf)
+                else:
+                    write(view[:read])
+            except (IOError, OSError) as err:
+                self.to_stderr(u"\n")
+                self.report_error(u'unable to write data: %s' % str(err))
+                return None
+
+            now = time.time()
+            if now - last_report < interval:
+                continue
+            last_report = now
+
+            # Progress message
+            speed = self.calc_speed(start, now, byte_counter - resume_len)
+            if data_len is None:
+                eta = percent = None
+            else:
+                percent = self.calc_percent(byte_counter, data_len)
+                eta = self.calc_eta(start, now, data_len - resume_len, byte_counter - resume_len)
+            self.report_progress(percent, data_len_str, speed, eta)
+
+            self._hook_progress({
+                'downloaded_bytes': byte_counter,
+                'total_bytes': data_len,
+                'tmpfilename': tmpfilename,
+                'filename': filename,
+                'status': 'downloading',
+                'eta': eta,
+                'speed': speed,
+            })
+
+            # Apply rate limit
+            self.slow_down(start, byte_counter - resume_len)
+
+        return (stream, tmpfilename, filename, byte_counter, None)
+
+    def _reconnect(self, url, headers, offset, end, error):
+        """Open url again from offset to end (or to the end of the file if
+        end is None) after a connection was lost.
+
+        Waits with an exponential backoff and some jitter between attempts.
+        Returns the new connection, or None once stream_retries reconnections
+        were made from offset without receiving data, or the download was
+        stopped. Each thread, segment worker or HLS segment, counts its
+        own attempts.
+        """
+        retries = self.params.get('stream_retries', 10)
+        backoff = self.params.get('retry_backoff', 1.0)
+        max_backoff = self.params.get('max_retry_backoff', 30.0)
+        lost = time.time()
+        stall = self._stall
+        if getattr(stall, 'position', None) != (url, offset):
+            # Data was received since the last reconnection, start over
+            stall.position = (url, offset)
+            stall.attempts = 0
+        try:
+            while self._go_on:
+                if stall.attempts >= retries:
+                    return None
+                self.lock.acquire()
+                self._reconnects += 1
+                self.lock.release()
+
+                delay = min(max_backoff, backoff * 2 ** stall.attempts)
+                # Full jitter, so that segments do not reconnect all at once
+                delay = random.uniform(0, delay)
+                stall.attempts += 1
+                self.to_screen(u'[download] Connection lost (%s), reconnecting from byte %d in %.1fs (%d/%d)'
+                               % (error, offset, delay, stall.attempts, retries))
+                self._stopped.wait(delay)
+                if not self._go_on:
+                    return None
+
+                request = compat_urllib_request.Request(url, None, headers)
+                if end is not None:
+                    request.add_header('Range', 'bytes=%d-%d' % (offset, end))
+                elif offset:
+                    request.add_header('Range', 'bytes=%d-' % offset)
+                try:
+                    return self._urlopen(request)
+                except compat_urllib_error.HTTPError as err:
+                    if err.code < 500 and err.code not in (408, 429):
+                        # Not going to get better, an expired URL for example
+                        self.report_warning(u'unable to reconnect: %s' % str(err))
+                        return None
+                    error = err
+                except (compat_urllib_error.URLError, socket.error, httplib.HTTPException) as err:
+                    error = err
+            return None
+        finally:
+            self.lock.acquire()
+            self._lost_time += time.time() - lost
+            self.lock.release()
+
+    def _skip(self, data, count):
+        """Read and drop the first count bytes of data, for servers that
+        ignored a Range header. Returns False if there were less."""
+        skipped = 0
+        while skipped < count:
+            data_block = data.read(min(65536, count - skipped))
+            if not data_block:
+                break
+            skipped += len(data_block)
+        return skipped == count
+
+    def _download_segmented(self, data, url, headers, filename, tmpfilename, data_len, segments,
+                            completed=None):
+        """Download data_len bytes from url over several connections.
+
+        data is the already opened connection, it is used for the first
+        range. Returns None when the server does not honour Range requests,
+        in which case data is left untouched and the caller should stream it.
+
+        The file is allocated first and filled in any order. The complete
+        ranges are saved next to it, completed being the ones an earlier
+        attempt saved. A connection that finishes its range takes over half
+        of the largest one left, and prioritize starts one where the player
+        needs data.
+        """
+        segment_len = data_len // segments
+        ranges = []
+        for i in range(segments):
+            start = i * segment_len
+            if i == segments - 1:
+                end = data_len - 1
+            else:
+                end = start + segment_len - 1
+            ranges.append((start, end))
+
+        def range_request(start, end):
+            request = compat_urllib_request.Request(url, None, headers)
+            request.add_header('Range', 'bytes=%d-%d' % (start, end))
+            return request
+
+        # Probe with the second range, servers ignoring Range answer 200
+        try:
+            probe = self._urlopen(range_request(*ranges[1]))
+        except (compat_urllib_error.HTTPError, compat_urllib_error.URLError):
+            return None
+        if probe.getcode() != 206:
+            probe.close()
+            self.to_screen(u'[download] Server ignored Range, using a single connection')
+            return None
+
+        ranges_filename = tmpfilename + u'.ranges'
+        min_segment_size = self.params.get('min_segment_size', 1048576)
+        scheduler = range_map.RangeScheduler(data_len, min_segment_size, completed)
+        try:
+            if completed is None:
+                # Before the file gets its full size, a run killed in between
+                # must not leave one that looks complete
+                scheduler.save(ranges_filename)
+                (stream, tmpfilename) = sanitize_open(tmpfilename, 'wb')
+                stream.truncate(data_len)
+            else:
+                (stream, tmpfilename) = sanitize_open(tmpfilename, 'r+b')
+            stream.close()
+        except (OSError, IOError) as err:
+            probe.close()
+            self.report_error(u'unable to open for writing: %s' % str(err))
+            return False
+        filename = self.undo_temp_name(tmpfilename)
+        self.report_destination(filename)
+
+        block_size = self.params.get('buffersize', 1024)
+        fast_block_size = self.params.get('fastbuffersize', 262144)
+        initial = scheduler.getCompleted()
+        errors = []
+        workers = []
+
+        klass = bandwidth.get_thread_class()
+
+        def fetch(claim, connection):
+            bandwidth.set_thread_class(klass)
+            stream = None
+            # Allocated once per connection, blocks are received straight into it
+            buf = bytearray(fast_block_size)
+            view = memoryview(buf)
+            try:
+                while claim is not None and self._go_on:
+                    if connection is None:
+                        connection = self._urlopen(range_request(claim.pos, claim.end))
+                        if connection.getcode() != 206:
+                            raise ContentTooShortError(0, claim.getRemaining())
+                    if stream is None:
+                        stream = open(encodeFilename(tmpfilename), 'r+b')
+                    stream.seek(claim.pos)
+                    while self._go_on:
+                        error = None
+                        read = 0
+                        try:
+                            if hasattr(connection, 'readinto'):
+                                read = connection.readinto(view[:min(fast_block_size, claim.getRemaining())])
+                            else:
+                                data_block = connection.read(min(block_size, claim.getRemaining()))
+                                read = len(data_block)
+                                buf[:read] = data_block
+                        except (socket.error, httplib.HTTPException) as err:
+                            error = err
+                        if not read:
+                            # Lost the connection, get the rest of the range again
+                            connection.close()
+                            connection = self._reconnect(url, headers, claim.pos, claim.end, error)
+                            if connection is None or connection.getcode() != 206:
+                                break
+                            continue
+                        stream.write(view[:read])
+                        if not scheduler.complete(claim, read):
+                            break
+                    if claim.getRemaining() > 0:
+                        if self._go_on:
+                            errors.append(ContentTooShortError(claim.pos, claim.end + 1))
+                        break
+                    # The range may have been shortened, the rest is not needed
+                    if connection is not None:
+                        connection.close()
+                        connection = None
+                    scheduler.release(claim)
+                    claim = scheduler.claimNext(segments)
+            except Exception as err:
+                errors.append(err)
+            finally:
+                if claim is not None:
+                    scheduler.release(claim)
+                if stream is not None:
+                    stream.close()
+                if connection is not None:
+                    connection.close()
+
+        def start_fetch(claim, connection=None):
+            worker = threading.Thread(target=fetch, args=(claim, connection))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        for index, (range_start, range_end) in enumerate(ranges):
+            connection = None
+            if index == 0:
+                connection = data
+            elif index == 1:
+                connection = probe
+            claim = scheduler.claimRange(range_start, range_end)
+            if claim is not None and claim.pos != range_start and connection is not None:
+                # Part of it was fetched before, that connection starts too early
+                connection.close()
+                connection = None
+            if claim is not None:
+                start_fetch(claim, connection)
+            elif connection is not None:
+                connection.close()
+
+        self.lock.acquire()
+        self._range_scheduler = scheduler
+        self._start_fetch = start_fetch
+        self.lock.release()
+
+        start = time.time()
+        byte_counter = initial
+        data_len_str = format_bytes(data_len)
+        last_save = start
+        try:
+            while True:
+                self.lock.acquire()
+                if not any(worker.is_alive() for worker in workers):
+                    # prioritize can not start more of them from now on
+                    self._range_scheduler = None
+                    self._start_fetch = None
+                    self.lock.release()
+                    break
+                self.lock.release()
+                time.sleep(0.1)
+                byte_counter = scheduler.getCompleted()
+                speed = self.calc_speed(start, time.time(), byte_counter - initial)
+                eta = self.calc_eta(start, time.time(), data_len - initial, byte_counter - initial)
+                self.report_progress(self.calc_percent(byte_counter, data_len), data_len_str, speed, eta)
+
+                if time.time() - last_save > 1:
+                    last_save = time.time()
+                    scheduler.save(ranges_filename)
+
+                self._hook_progress({
+                    'downloaded_bytes': byte_counter,
+                    # Only the head of the file is usable by a player reading the .part
+                    'contiguous_bytes': scheduler.getAvailable(0),
+                    'total_bytes': data_len,
+                    'tmpfilename': tmpfilename,
+                    'filename': filename,
+                    'status': 'downloading',
+                    'eta': eta,
+                    'speed': speed,
+                })
+        finally:
+            self.lock.acquire()
+            self._range_scheduler = None
+            self._start_fetch = None
+            self.lock.release()
+            scheduler.save(ranges_filename)
+
+        if not self._go_on:
+            return False
+        if errors:
             self.to_stderr(u"\n")
-            self.report_error(u'Did not get any data blocks')
+            self.report_error(u'unable to download segment: %s' % str(errors[0]))
             return False
-        stream.close()
+        byte_counter = scheduler.getCompleted()
         self.report_finish(data_len_str, (time.time() - start))
-        if data_len is not None and byte_counter != data_len:
-            raise ContentTooShortError(byte_counter, int(data_len))
+        if not scheduler.isComplete():
+            raise ContentTooShortError(byte_counter, data_len)
         self.try_rename(tmpfilename, filename)
-
-        # Update file modification time
-        if self.params.get('updatetime', True):
-            info_dict['filetime'] = self.try_utime(filename, data.info().get('last-modified', None))
+        try:
+            os.remove(encodeFilename(ranges_filename))
+        except OSError:
+            pass
 
         self._hook_progress({
             'downloaded_bytes': byte_counter,
@@ -705,13 +1553,34 @@ class FileDownloader(object):
         return True
 
     def _hook_progress(self, status):
-        self.lock.acquire()
+        """Call the progress hooks, without holding self.lock.
+
+        Successive "downloading" updates are coalesced according to the
+        progress_interval and progress_step options, any other status is
+        delivered right away. No hook is called once stop_download returned.
+        """
+        self._hook_lock.acquire()
+        try:
+            self._deliver_progress(status)
+        finally:
+            self._hook_lock.release()
+
+    def _deliver_progress(self, status):
         if not self._go_on:
-            self.lock.release()
             return
-        for ph in self._progress_hooks:
+        now = time.time()
+        downloaded = status.get('downloaded_bytes') or 0
+        if status['status'] == 'downloading' and self._last_hook_status == 'downloading':
+            step = self.params.get('progress_step')
+            if now - self._last_hook_time < self.params.get('progress_interval', 0.1) and \
+                    (step is None or downloaded - self._last_hook_bytes < step):
+                return
+        self._last_hook_status = status['status']
+        self._last_hook_time = now
+        self._last_hook_bytes = downloaded
+        status = dict(status, reconnects=self._reconnects, lost_time=self._lost_time)
+        for ph in list(self._progress_hooks):
             ph(status)
-        self.lock.release()
 
     def add_progress_hook(self, ph):
         """ ph gets called on download progress, with a dictionary with the entries
@@ -721,10 +1590,14 @@ class FileDownloader(object):
         It can also have some of the following entries:
 
         * downloaded_bytes: Bytes on disks
+        * contiguous_bytes: Bytes available from the start of tmpfilename,
+                            when the file is fetched in several ranges
         * total_bytes: Total bytes, None if unknown
         * tmpfilename: The filename we're currently writing to
         * eta: The estimated time in seconds, None if unknown
         * speed: The download speed in bytes/second, None if unknown
+        * reconnects: Times the connection was reopened after being lost
+        * lost_time: Seconds spent reconnecting
 
         Hooks are guaranteed to be called at least once (with status "finished")
         if the download is successful.
@@ -732,6 +1605,95 @@ class FileDownloader(object):
         self._progress_hooks.append(ph)
 
     def stop_download(self):
+        """Cancel the download, interrupting reads blocked in other threads.
+
+        Returns once the progress hooks being called, if any, returned.
+        """
         self.lock.acquire()
         self._go_on = False
+        self._stopped.set()
+        responses = self._responses
+        self._responses = []
+        processes = list(self._processes)
         self.lock.release()
+        for response in responses:
+            self._abort_response(response)
+        for process in processes:
+            process.stop()
+        # Wait for a hook being called, the next ones see _go_on
+        self._hook_lock.acquire()
+        self._hook_lock.release()
+
+    def is_stopped(self):
+        return not self._go_on
+
+    def prioritize(self, offset):
+        """Fetch the missing bytes from offset on before the others,
+        for example because the player seeked there.
+
+        Returns False if the running download can only be read in order.
+        """
+        # Held until the connection is started, so that the download does not end before
+        self.lock.acquire()
+        scheduler = self._range_scheduler
+        start_fetch = self._start_fetch
+        try:
+            if scheduler is None:
+                return False
+            claim = scheduler.prioritize(offset)
+            if claim is not None:
+                start_fetch(claim)
+            return True
+        finally:
+            self.lock.release()
+
+    def get_available(self, offset):
+        """Number of complete bytes from offset on in the temporary file
+        of the running segmented download, None for other downloads."""
+        self.lock.acquire()
+        scheduler = self._range_scheduler
+        self.lock.release()
+        if scheduler is None:
+            return None
+        return scheduler.getAvailable(offset)
+
+    def join(self, timeout=None):
+        """Wait for the running download or prefetch to return.
+
+        Returns False if it is still running after timeout seconds.
+        """
+        self._idle.wait(timeout)
+        return self._idle.is_set()
+
+    def _urlopen(self, request):
+        """Open request, the response gets aborted by stop_download."""
+        response = http_pool.urlopen(request, self.params.get('socket_timeout', socket._GLOBAL_DEFAULT_TIMEOUT))
+        self.lock.acquire()
+        cancelled = not self._go_on
+        if not cancelled:
+            # Drop the finished ones, HLS downloads open one per segment
+            self._responses = [r for r in self._responses if not self._response_done(r)]
+            self._responses.append(response)
+        self.lock.release()
+        if cancelled:
+            self._abort_response(response)
+        return response
+
+    def _close_responses(self):
+        self.lock.acquire()
+        responses = self._responses
+        self._responses = []
+        self.lock.release()
+        for response in responses:
+            response.close()
+
+    def _response_done(self, response):
+        done = getattr(response, 'isDone', None)
+        return done is not None and done()
+
+    def _abort_response(self, response):
+        abort = getattr(response, 'abort', None)
+        if abort is not None:
+            abort()
+        else:
+            response.close()
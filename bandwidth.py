@@ -0,0 +1,142 @@
+"""
+Process wide scheduling of the bandwidth used by all transfers.
+
+Every transfer belongs to a priority class. Received bytes are charged to
+a token bucket for the whole link, and while a playback download is
+active, to a bucket of their class too, so that thumbnails and
+background work can never starve the media being played.
+
+Transfers going through L{http_pool} are charged to the class of the
+thread that reads them, see L{set_thread_class}.
+"""
+import threading
+import time
+
+import singleflight
+from config import BANDWIDTH_LIMIT, THUMBNAILS_RATE_DURING_PLAYBACK, BACKGROUND_RATE_DURING_PLAYBACK
+
+# Priority classes, most important first
+PLAYBACK = 0
+THUMBNAILS = 1
+BACKGROUND = 2
+CLASS_NAMES = ["playback", "thumbnails", "background"]
+
+# A class is active if it received data in this number of seconds
+ACTIVITY_WINDOW = 1.0
+
+
+class TokenBucket(object):
+    """
+    Allows rate bytes per second on average, and bursts of up to burst
+    bytes. Consumers are charged after receiving data, so the balance can
+    get negative, a rate of 0 means no limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._last = time.time()
+
+    def refill(self, now):
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def getDelay(self):
+        """
+        Returns the number of seconds until the balance is positive again.
+        """
+        if not self.rate or self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+    def take(self, amount):
+        if self.rate:
+            self._tokens -= amount
+
+
+class BandwidthScheduler(object):
+    """
+    @ivar waited: Seconds spent waiting for bandwidth, per class
+    """
+
+    def __init__(self, rate=BANDWIDTH_LIMIT, thumbnails_rate=THUMBNAILS_RATE_DURING_PLAYBACK,
+                 background_rate=BACKGROUND_RATE_DURING_PLAYBACK):
+        self._link = TokenBucket(rate)
+        # Only used while a playback download is active
+        self._buckets = {THUMBNAILS: TokenBucket(thumbnails_rate),
+                         BACKGROUND: TokenBucket(background_rate)}
+        self._last_active = [0] * len(CLASS_NAMES)
+        self._waiting = [0] * len(CLASS_NAMES)
+        self._cond = threading.Condition()
+        self.waited = [0.0] * len(CLASS_NAMES)
+
+    def consume(self, klass, amount):
+        """
+        Charges amount bytes received by a transfer of class klass, after
+        waiting until the link and the class are within their budgets, and
+        no transfer of a more important class is waiting.
+        """
+        start = time.time()
+        self._cond.acquire()
+        try:
+            self._waiting[klass] += 1
+            while True:
+                now = time.time()
+                self._link.refill(now)
+                delay = self._link.getDelay()
+                bucket = self._buckets.get(klass)
+                if bucket is not None:
+                    bucket.refill(now)
+                    if self._isActive(PLAYBACK, now):
+                        delay = max(delay, bucket.getDelay())
+                if delay <= 0 and not sum(self._waiting[:klass]):
+                    break
+                # Woken up early when the more important transfers are done
+                self._cond.wait(delay or ACTIVITY_WINDOW)
+            self._waiting[klass] -= 1
+
+            self._link.take(amount)
+            if bucket is not None and self._isActive(PLAYBACK, now):
+                bucket.take(amount)
+            self._last_active[klass] = now
+            self.waited[klass] += now - start
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def isActive(self, klass):
+        self._cond.acquire()
+        try:
+            return self._isActive(klass, time.time())
+        finally:
+            self._cond.release()
+
+    def getStats(self):
+        self._cond.acquire()
+        try:
+            return dict((name, round(waited, 2)) for name, waited in zip(CLASS_NAMES, self.waited))
+        finally:
+            self._cond.release()
+
+    def _isActive(self, klass, now):
+        return now - self._last_active[klass] < ACTIVITY_WINDOW
+
+
+_local = threading.local()
+
+
+def set_thread_class(klass):
+    """
+    Sets the class the transfers of the calling thread are charged to,
+    threads that never call this are considered as playing media.
+    """
+    _local.klass = klass
+
+
+def get_thread_class():
+    return getattr(_local, "klass", PLAYBACK)
+
+
+get_default_scheduler = singleflight.once(BandwidthScheduler)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python2
+"""
+Micro-benchmark of the FileDownloader read loops.
+
+Streams an in memory payload through FileDownloader._do_download, once
+with a connection that only offers read() and once with one that offers
+readinto(), and prints the throughput of both loops.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from FileDownloader import FileDownloader
+
+PAYLOAD_SIZE = 512 * 1024 * 1024
+SOURCE = bytearray(4 * 1024 * 1024)
+
+
+class DummyYdl(object):
+    def to_screen(self, *args, **kargs):
+        pass
+
+    def to_console_title(self, message):
+        pass
+
+    def report_error(self, *args, **kargs):
+        print args
+
+
+class ReadResponse(object):
+    def __init__(self, size):
+        self._left = size
+        self._headers = {'Content-length': str(size)}
+        self._source = memoryview(SOURCE)
+
+    def info(self):
+        return self._headers
+
+    def read(self, amt):
+        amt = min(amt, self._left, len(SOURCE))
+        self._left -= amt
+        return self._source[:amt].tobytes()
+
+
+class ReadIntoResponse(ReadResponse):
+    def readinto(self, buf):
+        amt = min(len(buf), self._left, len(SOURCE))
+        self._left -= amt
+        buf[:amt] = self._source[:amt]
+        return amt
+
+
+def run(response_class, directory):
+    downloader = FileDownloader(DummyYdl(), {'noprogress': True, 'updatetime': False})
+    hook_calls = []
+    downloader.add_progress_hook(hook_calls.append)
+    filename = os.path.join(directory, response_class.__name__)
+    info_dict = {'url': 'http://localhost/bench',
+                 'urlhandle': response_class(PAYLOAD_SIZE)}
+    start = time.time()
+    downloader._do_download(unicode(filename), info_dict)
+    elapsed = time.time() - start
+    os.remove(filename)
+    return PAYLOAD_SIZE / elapsed, len(hook_calls)
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    try:
+        results = {}
+        for response_class in (ReadResponse, ReadIntoResponse):
+            speed, hooks = run(response_class, directory)
+            results[response_class] = speed
+            print "%-16s %8.1f MB/s, %d progress hooks" % (response_class.__name__,
+                                                             speed / 1024 / 1024, hooks)
+        print "speedup: %.2fx" % (results[ReadIntoResponse] / results[ReadResponse])
+    finally:
+        shutil.rmtree(directory)
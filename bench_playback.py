@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+"""
+Micro-benchmark of switching the played media.
+
+Switches back and forth between a video and an audio only media, once
+building a new pipeline with parse_launch for each switch as gtube used
+to, tearing down the previous one, and once loading them in a single
+L{PlaybackEngine}. Prints the time from the switch to the first frame,
+that is until the pipeline prerolled.
+
+Fake sinks are used so that it runs without a display or a sound card,
+video media given on the command line are played instead of generated
+ones.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from gi.repository import GLib
+from gi.repository import Gst
+Gst.init([])
+
+from pipeline import PlaybackEngine
+
+SWITCHES = 50
+TIMEOUT = 10 * Gst.SECOND
+
+VIDEO_LAUNCH = "uridecodebin uri=%s name=d ! videoconvert ! fakesink d. ! audioconvert ! fakesink"
+AUDIO_LAUNCH = ("uridecodebin uri=%s ! tee name=t ! queue ! audioresample ! audioconvert ! "
+                "synaescope shader=3 ! videoconvert ! fakesink t. ! queue ! audioresample ! "
+                "audioconvert ! fakesink")
+
+
+def generate(directory):
+    video = os.path.join(directory, "video.ogg")
+    audio = os.path.join(directory, "audio.ogg")
+    for launch in ("videotestsrc num-buffers=150 ! theoraenc ! oggmux name=m ! filesink location=%s "
+                   "audiotestsrc num-buffers=250 ! audioconvert ! vorbisenc ! m." % video,
+                   "audiotestsrc num-buffers=250 ! audioconvert ! vorbisenc ! oggmux ! "
+                   "filesink location=%s" % audio):
+        pipeline = Gst.parse_launch(launch)
+        pipeline.set_state(Gst.State.PLAYING)
+        pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+                                              Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        pipeline.set_state(Gst.State.NULL)
+    return [(video, False), (audio, True)]
+
+
+def preroll(pipeline):
+    pipeline.set_state(Gst.State.PAUSED)
+    change, unused_state, unused_pending = pipeline.get_state(TIMEOUT)
+    if change == Gst.StateChangeReturn.FAILURE:
+        raise RuntimeError("could not preroll")
+
+
+def run_parse_launch(medias):
+    latencies = []
+    previous = None
+    for i in range(SWITCHES):
+        path, audio_only = medias[i % len(medias)]
+        uri = GLib.filename_to_uri(path, None)
+        start = time.time()
+        if audio_only:
+            pipeline = Gst.parse_launch(AUDIO_LAUNCH % uri)
+        else:
+            pipeline = Gst.parse_launch(VIDEO_LAUNCH % uri)
+        if previous is not None:
+            previous.set_state(Gst.State.NULL)
+        preroll(pipeline)
+        latencies.append(time.time() - start)
+        previous = pipeline
+    previous.set_state(Gst.State.NULL)
+    return latencies
+
+
+def run_engine(medias):
+    engine = PlaybackEngine(video_sink="fakesink", audio_sink="fakesink")
+    latencies = []
+    for i in range(SWITCHES):
+        path, audio_only = medias[i % len(medias)]
+        start = time.time()
+        engine.load(GLib.filename_to_uri(path, None), audio_only)
+        # The previous media is shut down by the worker
+        engine.waitStateChanges()
+        preroll(engine._pipeline)
+        latencies.append(time.time() - start)
+    engine.release()
+    engine.waitStateChanges()
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    average = sum(latencies) / len(latencies)
+    print "%-12s average %6.1f ms, median %6.1f ms, worst %6.1f ms" % (
+        name, average * 1000, latencies[len(latencies) / 2] * 1000, latencies[-1] * 1000)
+    return average
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    try:
+        if len(sys.argv) > 1:
+            medias = [(os.path.abspath(path), False) for path in sys.argv[1:]]
+        else:
+            medias = generate(directory)
+        old = report("parse_launch", run_parse_launch(medias))
+        new = report("engine", run_engine(medias))
+        print "speedup: %.2fx" % (old / new)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,219 @@
+"""
+How much of a media that is still being downloaded has to be there before
+it can be played without running out of data, and supervision of its
+playback so that it waits for the download instead of running out.
+"""
+import time
+
+from gi.repository import GLib
+from gi.repository import Gst
+
+from loggable import Loggable
+from pipeline import PipelineError
+from signallable import Signallable
+from config import (MINIMUM_DOWNLOADED_SIZE, PLAYBACK_START_BUFFER,
+                    PLAYBACK_MINIMUM_SIZE, DOWNLOAD_SPEED_MARGIN, STALL_MARGIN)
+
+# Milliseconds between two checks of the playback position
+WATCHDOG_INTERVAL = 250
+
+
+def get_bitrate(total_bytes, duration):
+    """
+    Returns the bytes per second of a media of total_bytes lasting
+    duration seconds, or None if either is unknown.
+    """
+    try:
+        duration = float(duration)
+    except (TypeError, ValueError):
+        return None
+    if not total_bytes or duration <= 0:
+        return None
+    return total_bytes / duration
+
+
+def get_start_threshold(remaining, bitrate, speed):
+    """
+    Returns the number of bytes after the playback position to download
+    before playing from there, remaining being the number of bytes from
+    the position to the end of the media. Any argument can be None if it
+    is not known yet, MINIMUM_DOWNLOADED_SIZE is used then.
+
+    The download has the time the rest of the media plays to fetch the
+    rest of it, at speed divided by DOWNLOAD_SPEED_MARGIN. What it would
+    not make in time is the threshold, but at least PLAYBACK_START_BUFFER
+    seconds are buffered against variations of the speed.
+    """
+    if not remaining or not bitrate or speed is None:
+        if remaining:
+            return min(MINIMUM_DOWNLOADED_SIZE, remaining)
+        return MINIMUM_DOWNLOADED_SIZE
+    play_time = float(remaining) / bitrate
+    late = remaining - speed / DOWNLOAD_SPEED_MARGIN * play_time
+    threshold = max(late, bitrate * PLAYBACK_START_BUFFER, PLAYBACK_MINIMUM_SIZE)
+    return int(min(threshold, remaining))
+
+
+class BufferingSupervisor(Signallable, Loggable):
+    """
+    Watches a L{SimplePipeline} playing a file that is still being
+    downloaded. When playback gets close to what is not downloaded yet, or
+    reaches the end of the file, the pipeline is paused until enough bytes
+    are there to play again, then resumed at the same position.
+
+    get_available(offset) returns the number of bytes downloaded from
+    offset on, it is called from the main loop.
+
+    Signals:
+     - C{stalled} : Playback was paused to wait for the download.
+     - C{resumed} : Playback resumed after waiting for duration seconds.
+    """
+
+    __signals__ = {
+        "stalled": ["position"],
+        "resumed": ["duration"],
+    }
+
+    def __init__(self, pipeline, get_available):
+        Loggable.__init__(self)
+        self.pipeline = pipeline
+        self._get_available = get_available
+        self._total_bytes = None
+        self._speed = None
+        self._finished = False
+        self._position = 0
+        # Byte the stall happened at, when it started and whether to play afterwards
+        self._stalled_offset = None
+        self._stalled_since = None
+        self._resume_playing = False
+        self._stall_durations = []
+
+        self.pipeline.connect("eos", self._eosCb)
+        self.pipeline.connect("position", self._positionCb)
+        self._watchdog_id = GLib.timeout_add(WATCHDOG_INTERVAL, self._watchdogCb)
+
+    def notifyProgress(self, total_bytes, speed):
+        """
+        Called with the progress of the download, from any thread.
+        """
+        self._total_bytes = total_bytes
+        self._speed = speed
+
+    def finish(self):
+        """
+        The download is complete, any stall ends at the next check.
+        """
+        self._finished = True
+
+    def seeked(self, position):
+        """
+        The application seeked to position, any stall ends there.
+        """
+        self._position = position
+        if self._stalled_since is not None:
+            self._stall_durations.append(time.time() - self._stalled_since)
+            self._stalled_offset = None
+            self._stalled_since = None
+
+    def release(self):
+        if self._watchdog_id:
+            GLib.source_remove(self._watchdog_id)
+            self._watchdog_id = 0
+        self.pipeline.disconnect_by_func(self._eosCb)
+        self.pipeline.disconnect_by_func(self._positionCb)
+
+    def isStalled(self):
+        return self._stalled_since is not None
+
+    def getStats(self):
+        """
+        Returns the number of stalls, and the seconds they lasted in total
+        and at most, the current stall included.
+        """
+        durations = list(self._stall_durations)
+        if self._stalled_since is not None:
+            durations.append(time.time() - self._stalled_since)
+        return {"stalls": len(durations),
+                "stalled_time": sum(durations),
+                "longest_stall": max(durations or [0])}
+
+    def _getBitrate(self):
+        try:
+            duration = self.pipeline.getDuration()
+        except PipelineError:
+            return None
+        if duration in (None, Gst.CLOCK_TIME_NONE):
+            return None
+        return get_bitrate(self._total_bytes, float(duration) / Gst.SECOND)
+
+    def _getOffset(self, position, bitrate):
+        # Assumes a constant bitrate, as the seeks do
+        return min(self._total_bytes - 1, int(bitrate * position / Gst.SECOND))
+
+    def _stall(self, offset):
+        self._stalled_offset = offset
+        self._stalled_since = time.time()
+        self._resume_playing = True
+        self.pipeline.pause()
+        self.info("stalled at byte %d", offset)
+        self.emit("stalled", self._position)
+
+    def _resume(self):
+        duration = time.time() - self._stalled_since
+        self._stall_durations.append(duration)
+        self._stalled_offset = None
+        self._stalled_since = None
+        self.info("resuming after %.1f seconds", duration)
+        try:
+            # Needed after EOS, and harmless after a pause
+            self.pipeline.simple_seek(self._position)
+            if self._resume_playing:
+                self.pipeline.play()
+        except PipelineError, e:
+            self.warning("could not resume playback: %s", e)
+        self.emit("resumed", duration)
+
+    def _positionCb(self, unused_pipeline, position):
+        if self._stalled_since is None:
+            self._position = position
+
+    def _eosCb(self, unused_pipeline):
+        if self._finished or self._stalled_since is not None:
+            return
+        # Played everything that was there, SimplePipeline paused already
+        bitrate = self._getBitrate()
+        if bitrate is not None:
+            offset = self._getOffset(self._position, bitrate)
+        else:
+            offset = self._get_available(0)
+        self._stall(offset)
+
+    def _watchdogCb(self):
+        total_bytes = self._total_bytes
+        if self._stalled_since is not None:
+            if self._finished:
+                self._resume()
+                return True
+            remaining = total_bytes - self._stalled_offset if total_bytes else None
+            threshold = get_start_threshold(remaining, self._getBitrate(), self._speed)
+            if self._get_available(self._stalled_offset) >= threshold:
+                self._resume()
+            return True
+
+        if self._finished or not total_bytes:
+            return True
+        if self.pipeline.getState() != Gst.State.PLAYING:
+            return True
+        bitrate = self._getBitrate()
+        if bitrate is None:
+            # Only the end of the file can be noticed
+            return True
+        try:
+            self._position = self.pipeline.getPosition()
+        except PipelineError:
+            return True
+        offset = self._getOffset(self._position, bitrate)
+        margin = min(total_bytes - offset, bitrate * STALL_MARGIN)
+        if self._get_available(offset) < margin:
+            self._stall(offset)
+        return True
@@ -2,11 +2,48 @@ import os
 
 DEBUG=0  # No real effect, will dump results from youtube gdata search if activated
 RESULT_COLUMNS=3  # Display the thumbnails on this amount of columns
-MINIMUM_DOWNLOADED_SIZE = 1000000  # Wait for this number of bytes downloaded before playing
+THUMBNAIL_WIDTH = 320  # Thumbnails larger than this are scaled down
+THUMBNAIL_HEIGHT = 240
+THUMBNAIL_WORKERS = 4  # Number of thumbnails fetched at the same time
+THUMBNAIL_CACHE_DIRECTORY=os.path.join(os.path.expanduser("~"), ".cache", "gtube", "thumbnails")  # Place where to keep thumbnails
+THUMBNAIL_CACHE_SIZE = 100 * 1024 * 1024  # Evict least recently shown thumbnails above this number of bytes
+THUMBNAIL_CACHE_TTL = 24 * 3600  # Show cached thumbnails without asking the server for this number of seconds
+SEARCH_DEADLINE = 10  # Ignore the results of a service that takes more than this number of seconds
+RESULTS_PER_PAGE = 25  # Number of results asked to each service
+SEARCH_CACHE_TTL = 3600  # Reuse the results of a search for this number of seconds
+SEARCH_CACHE_ENTRIES = 200  # Maximum number of searches kept in the cache
+SEARCH_CACHE_FILE=os.path.join(os.path.expanduser("~"), ".cache", "gtube", "searches.json")  # None to only cache in memory
+MINIMUM_DOWNLOADED_SIZE = 1000000  # Wait for this number of bytes downloaded before playing, if the bitrate or the download speed are not known
+PLAYBACK_START_BUFFER = 2  # Otherwise wait for what the download would not fetch in time, and at least this number of seconds of media
+PLAYBACK_MINIMUM_SIZE = 64 * 1024  # And at least this number of bytes, for the headers of the container
+DOWNLOAD_SPEED_MARGIN = 1.5  # Start playback as if the download was this number of times slower than measured
+STALL_MARGIN = 1  # Pause playback when less than this number of seconds of media are downloaded ahead of it
+DOWNLOAD_SEGMENTS = 4  # Number of parallel connections used to download a media, 1 to disable
+DOWNLOAD_TIMEOUT = 20  # Give up on a connection that sent nothing for this number of seconds
+INFO_CACHE_TTL = 1800  # Reuse the infos of a media page for at most this number of seconds
+INFO_CACHE_ENTRIES = 500  # Maximum number of media pages whose infos are kept
+INFO_RESOLVER_WORKERS = 1  # Number of media pages resolved at the same time in the background
+INFO_RESOLVE_AHEAD = 5  # Resolve the media pages of this number of search results in the background, 0 to disable
+
+HTTP_POOL_MAX_IDLE_PER_HOST = 6  # Keep-alive connections kept open to a same host
+HTTP_POOL_MAX_IDLE = 32  # Keep-alive connections kept open in total
+HTTP_POOL_IDLE_TIMEOUT = 30  # Close keep-alive connections unused for this number of seconds
+
+BANDWIDTH_LIMIT = 0  # Bytes per second shared by all the transfers, 0 if unknown
+THUMBNAILS_RATE_DURING_PLAYBACK = 256 * 1024  # Bytes per second left to thumbnails while a media downloads for playback
+BACKGROUND_RATE_DURING_PLAYBACK = 64 * 1024  # Same for prefetch, metadata resolution and other background downloads
 
 MUSIC_DIRECTORY=os.path.join(os.path.expanduser("~"), "Music")  # Place where to save converted media
 VIDEO_DIRECTORY=os.path.join(os.path.expanduser("~"), "Videos")  # Place where to store downloaded media as is
+MEDIA_CACHE_DIRECTORY=os.path.join(os.path.expanduser("~"), ".cache", "gtube", "media")  # Place where to keep played media
+MEDIA_CACHE_SIZE = 2 * 1024 * 1024 * 1024  # Evict least recently played media above this number of bytes
+MEDIA_CACHE_PARTIAL_GRACE = 600  # Never evict the files of an unfinished download written to less than this number of seconds ago
+
+PREFETCH_ENTRIES = 3  # Prefetch the beginning of this number of search results, 0 to disable
+PREFETCH_RATE_LIMIT = 512 * 1024  # Maximum bytes per second used by each prefetch
+PREFETCH_DISK_BUDGET = 50 * 1024 * 1024  # Maximum bytes of prefetched media not played yet
 
 # Gstreamer encoder to use, wavenc is another example, you can have a look at the available encoders
 # with gst-inspect-1.0
 AUDIO_ENCODER="wavenc"
+CONVERTER_WORKERS = 0  # Number of conversions run at the same time, 0 for one per processor
@@ -1,45 +1,310 @@
 from gi.repository import Gst
+from gi.repository import GstPbutils
 from gi.repository import GLib
 
+import heapq
+import itertools
+import multiprocessing
 import thread
-import urllib
+import threading
 import os
-from pipeline import SimplePipeline
-from config import MUSIC_DIRECTORY, AUDIO_ENCODER
+from pipeline import SimplePipeline, PipelineError
+from signallable import Signallable
+from config import MUSIC_DIRECTORY, AUDIO_ENCODER, CONVERTER_WORKERS
 
-class ConverterQueue:
-    def __init__(self):
+# Encoder element -> (encoded caps, parser and muxer, extension), used to copy
+# already encoded audio to the target container instead of encoding it again
+REMUXERS = {
+    "vorbisenc": ("audio/x-vorbis", "vorbisparse ! oggmux", "ogg"),
+    "opusenc": ("audio/x-opus", "opusparse ! oggmux", "ogg"),
+    "flacenc": ("audio/x-flac", "flacparse", "flac"),
+    "lamemp3enc": ("audio/mpeg, mpegversion=(int)1, layer=(int)3", "mpegaudioparse ! id3v2mux", "mp3"),
+    "faac": ("audio/mpeg, mpegversion=(int)4", "aacparse ! mp4mux", "m4a"),
+    "voaacenc": ("audio/mpeg, mpegversion=(int)4", "aacparse ! mp4mux", "m4a"),
+    "avenc_aac": ("audio/mpeg, mpegversion=(int)4", "aacparse ! mp4mux", "m4a"),
+}
+
+# Maximum number of nanoseconds spent looking at the streams of a media
+DISCOVERER_TIMEOUT = 5 * Gst.SECOND
+
+
+class ConversionJob(object):
+    """
+    A media to convert, its status is one of "queued", "running", "done"
+    and "failed". Once running, mode tells whether the audio is copied
+    as is ("remux") or decoded and encoded again ("transcode").
+    """
+    def __init__(self, uri, target, priority, source=None):
+        self.uri = uri
+        self.target = target
+        self.priority = priority
+        self.source = source
+        self.status = "queued"
+        self.mode = None
+        self.error = None
+        self.pipeline = None
+
+
+class GrowingFileSource(object):
+    """
+    Feeds an appsrc with a file that is still being downloaded.
+
+    Only the first available bytes of the file are read, the feeder waits
+    for more instead of stopping at the end of the file, until L{finish}
+    or L{abort} is called.
+    """
+    BLOCK_SIZE = 65536
+
+    def __init__(self, path, available=0):
+        self.path = path
+        # The download gets renamed once complete, keep the same file open
+        self._stream = open(path, "rb")
+        self._available = available
+        self._finished = False
+        self._aborted = False
+        self._started = False
+        self._cond = threading.Condition()
+
+    def notifyProgress(self, available):
+        self._cond.acquire()
+        self._available = max(self._available, available)
+        self._cond.notify_all()
+        self._cond.release()
+
+    def finish(self):
+        self._cond.acquire()
+        self._finished = True
+        self._cond.notify_all()
+        self._cond.release()
+
+    def abort(self):
+        self._cond.acquire()
+        self._aborted = True
+        if not self._started:
+            self._stream.close()
+        self._cond.notify_all()
+        self._cond.release()
+
+    def isDone(self):
+        return self._finished or self._aborted
+
+    def start(self, appsrc):
+        self._cond.acquire()
+        self._started = True
+        self._cond.release()
+        feeder = threading.Thread(target=self._run, args=(appsrc,))
+        feeder.daemon = True
+        feeder.start()
+
+    def _run(self, appsrc):
+        offset = 0
+        try:
+            while not self._aborted:
+                self._cond.acquire()
+                finished = self._finished
+                to_read = min(self.BLOCK_SIZE, self._available - offset)
+                if to_read <= 0 and not finished:
+                    self._cond.wait(0.5)
+                self._cond.release()
+
+                if to_read > 0:
+                    data = self._stream.read(to_read)
+                elif finished:
+                    # The whole file is there now
+                    data = self._stream.read(self.BLOCK_SIZE)
+                    if not data:
+                        appsrc.emit("end-of-stream")
+                        return
+                else:
+                    continue
+                offset += len(data)
+                if appsrc.emit("push-buffer", Gst.Buffer.new_wrapped(data)) != Gst.FlowReturn.OK:
+                    return
+        finally:
+            self._stream.close()
+
+
+class ConverterQueue(Signallable):
+    """
+    Runs up to CONVERTER_WORKERS conversions at the same time, jobs are
+    started by priority (lowest first) then in the order they were queued.
+
+    Signals:
+     - C{job-changed} : The status of a job changed.
+    """
+
+    __signals__ = {
+        "job-changed": ["job"],
+    }
+
+    def __init__(self, workers=CONVERTER_WORKERS, encoder=AUDIO_ENCODER):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.encoder = encoder
+        self._remuxer = REMUXERS.get(encoder.split("!")[0].strip())
         self._queued = []
+        self._running = []
+        self._jobs = []
+        self._counter = itertools.count()
         self._lock = thread.allocate_lock()
-        self.pipeline = None
+        # uri -> jobs waiting for the streams of their media to be known
+        self._discovering = {}
+        self._discoverer = None
+
+    def enqueue(self, uri, target, priority=0):
+        job = ConversionJob(GLib.filename_to_uri(uri, None), self._makeTarget(target), priority)
+        self._push(job)
+        return job
 
-    def enqueue(self, uri, target):
+    def enqueueGrowing(self, path, target, available, priority=0):
+        """
+        Converts a file that is still being downloaded, available being the
+        number of bytes that can already be read. The caller reports the
+        progress of the download through job.source.
+        """
+        source = GrowingFileSource(path, available)
+        job = ConversionJob(GLib.filename_to_uri(path, None), self._makeTarget(target), priority, source)
+        self._push(job)
+        return job
+
+    def cancel(self, job):
+        """
+        Stops a job, for example because its download was interrupted.
+        """
+        self._lock.acquire()
+        for i, (unused_priority, unused_count, queued_job) in enumerate(self._queued):
+            if queued_job is job:
+                del self._queued[i]
+                heapq.heapify(self._queued)
+                break
+        self._lock.release()
+
+        if job.status == "running":
+            self._finish(job, "failed", "cancelled")
+        elif job.status == "queued":
+            if job.source is not None:
+                job.source.abort()
+            job.status = "failed"
+            job.error = "cancelled"
+            self.emit("job-changed", job)
+
+    def getJobs(self):
         self._lock.acquire()
-        self._queued.append((GLib.filename_to_uri(uri, None), target))
+        jobs = list(self._jobs)
         self._lock.release()
+        return jobs
+
+    def _makeTarget(self, title):
+        if self._remuxer is not None:
+            extension = "." + self._remuxer[2]
+        else:
+            # Really crappy way to figure out an extension
+            extension = "." + self.encoder.split('enc')[0][-3:]
+        return os.path.join(MUSIC_DIRECTORY, GLib.uri_escape_string(title, None, False) + extension)
+
+    def _push(self, job):
+        self._lock.acquire()
+        heapq.heappush(self._queued, (job.priority, self._counter.next(), job))
+        self._jobs.append(job)
+        self._lock.release()
+        self.emit("job-changed", job)
         self._dequeue()
 
     def _dequeue(self):
-        self._lock.acquire()
-        if not self._queued:
+        while True:
+            self._lock.acquire()
+            if not self._queued or len(self._running) >= self.workers:
+                self._lock.release()
+                return
+            unused_priority, unused_count, job = heapq.heappop(self._queued)
+            self._running.append(job)
             self._lock.release()
+            self._start(job)
+
+    def _start(self, job):
+        job.status = "running"
+        self.emit("job-changed", job)
+
+        if job.source is not None or self._remuxer is None:
+            # A file being downloaded can not be looked at before it is complete
+            self._launch(job, "transcode")
             return
-        uri, target = self._queued.pop()
-        # Really crappy way to figure out an extension
-        extension = "." + AUDIO_ENCODER.split('enc')[0][-3:]
 
-        target = os.path.join(MUSIC_DIRECTORY, GLib.uri_escape_string(target, None, False) + extension)
-        self._lock.release()
-        pipeline = Gst.parse_launch("uridecodebin uri=" + uri + " ! " + AUDIO_ENCODER + " ! filesink location=" + target)
+        # Find out whether the audio needs to be encoded again first
+        if self._discoverer is None:
+            self._discoverer = GstPbutils.Discoverer.new(DISCOVERER_TIMEOUT)
+            self._discoverer.connect("discovered", self._discoveredCb)
+            self._discoverer.start()
+        jobs = self._discovering.setdefault(job.uri, [])
+        jobs.append(job)
+        if len(jobs) == 1 and not self._discoverer.discover_uri_async(job.uri):
+            del self._discovering[job.uri]
+            for job in jobs:
+                self._launch(job, "transcode")
+
+    def _discoveredCb(self, discoverer, info, error):
+        jobs = self._discovering.pop(info.get_uri(), [])
+        mode = "transcode"
+        if error is None:
+            encoded = Gst.Caps.from_string(self._remuxer[0])
+            streams = info.get_audio_streams()
+            if streams and streams[0].get_caps().can_intersect(encoded):
+                mode = "remux"
+        for job in jobs:
+            self._launch(job, mode)
+
+    def _launch(self, job, mode):
+        if mode == "remux":
+            # Stop decoding as soon as the encoded audio is found
+            launch = "uridecodebin uri=%s caps=\"%s\" ! %s" % (job.uri, self._remuxer[0], self._remuxer[1])
+        elif job.source is not None:
+            # Block when enough data is queued, rather than reading the whole file in memory
+            launch = "appsrc name=src block=true max-bytes=1048576 ! decodebin ! " + self.encoder
+        else:
+            launch = "uridecodebin uri=" + job.uri + " ! " + self.encoder
+        job.mode = mode
+        try:
+            pipeline = Gst.parse_launch(launch + " ! filesink location=" + job.target)
+        except GLib.GError, e:
+            self._finish(job, "failed", str(e))
+            return
+        if job.source is not None:
+            job.source.start(pipeline.get_by_name("src"))
+        job.pipeline = SimplePipeline(pipeline, None)
+        job.pipeline.connect("eos", self._eosCb, job)
+        job.pipeline.connect("error", self._errorCb, job)
+        self.emit("job-changed", job)
+        try:
+            job.pipeline.setState(Gst.State.PLAYING)
+        except PipelineError, e:
+            self._finish(job, "failed", str(e))
+
+    def _eosCb(self, pipeline, job):
+        self._finish(job, "done")
 
-        if self.pipeline:
-            self.pipeline.disconnect_by_func(self._eosCb)
-            self.pipeline.setState(Gst.State.NULL)
+    def _errorCb(self, pipeline, message, details, job):
+        self._finish(job, "failed", message)
+
+    def _finish(self, job, status, error=None):
+        self._lock.acquire()
+        if job not in self._running:
+            self._lock.release()
+            return
+        self._running.remove(job)
+        self._lock.release()
 
-        self.pipeline = SimplePipeline(pipeline, None)
-        self.pipeline.connect("eos", self._eosCb)
-        self.pipeline.setState(Gst.State.PLAYING)
+        jobs = self._discovering.get(job.uri)
+        if jobs is not None and job in jobs:
+            # Whatever is discovered will be ignored
+            jobs.remove(job)
+        if job.source is not None:
+            job.source.abort()
+        if job.pipeline is not None:
+            job.pipeline.disconnect_by_func(self._eosCb)
+            job.pipeline.disconnect_by_func(self._errorCb)
+            job.pipeline.release()
+            job.pipeline = None
+        job.status = status
+        job.error = error
 
-    def _eosCb(self, pipeline):
-        pipeline.setState(Gst.State.NULL)
+        self.emit("job-changed", job)
         self._dequeue()
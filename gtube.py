@@ -8,18 +8,28 @@ from gi.repository import GLib
 from gi.repository import Gst
 Gst.init([])
 
-import urllib
+import functools
 import os
 import thread
+import threading
 import shutil
 
 from youtube_service import YouTubeService
 from soundcloud_service import SoundCloudService
 from converter_queue import ConverterQueue
+from service_interface import CONVERT, KEEP
+from prefetcher import Prefetcher
+from thumbnailer import ThumbnailPool
 from viewer import PitiviViewer
-from pipeline import SimplePipeline
-from config import RESULT_COLUMNS, MINIMUM_DOWNLOADED_SIZE, MUSIC_DIRECTORY, VIDEO_DIRECTORY
+from pipeline import PlaybackEngine, PipelineError
+from misc import print_ns
+from config import RESULT_COLUMNS, MUSIC_DIRECTORY, VIDEO_DIRECTORY, SEARCH_DEADLINE, INFO_RESOLVE_AHEAD
 from check import check_hard_dependencies
+from config import DEBUG
+import bandwidth
+import buffering
+import http_pool
+import info_cache
 
 from random import shuffle
 
@@ -31,10 +41,36 @@ class Crawler(Gtk.Application):
         self._soundcloud_service = None
         self._services = None
         self._current_service = None
+        self._search_id = 0
+        self._next_cell = 0
+        self._pending_services = set()
         self._alreadyPlaying = False
         self._gridLock = thread.allocate_lock()
         self._current_state = Gst.State.PAUSED
+        self._current_uri = None
+        self._current_tmpfilename = None
+        self._available_bytes = 0
+        self._total_bytes = None
+        # Bytes per second of the download for playback, and the
+        # (threshold, bitrate, speed) that decided to start playing
+        self._download_speed = None
+        self._start_decision = None
+        self._streaming_job = None
+        # Downloader of what is played, and (position, format, playing) of a
+        # seek waiting for its bytes to be downloaded
+        self._downloader = None
+        self._pending_seek = None
+        # Threads of the downloads for playback that did not return yet
+        self._download_threads = []
+        # Latest (downloaded, total) bytes, and whether the labels update is queued
+        self._bytes_counts = None
+        self._bytes_update_queued = False
+        # Pauses playback when it catches up with the download
+        self._buffering = None
         self._converter_queue = ConverterQueue()
+        self._converter_queue.connect("job-changed", self._conversionJobChangedCb)
+        self._prefetcher = Prefetcher()
+        self._thumbnailer = ThumbnailPool()
         self.pipeline = None
 
         gtksettings = Gtk.Settings.get_default()
@@ -49,9 +85,6 @@ class Crawler(Gtk.Application):
         if not os.path.exists(VIDEO_DIRECTORY):
             os.mkdir(VIDEO_DIRECTORY)
 
-        if not os.path.exists(os.path.join(os.getcwd(), "data")):
-            os.mkdir(os.path.join(os.getcwd(), "data"))
-
     def _startupCb(self, _):
         self.builder = Gtk.Builder()
         self.builder.add_from_file("crawler.ui")
@@ -96,19 +129,8 @@ class Crawler(Gtk.Application):
             label.hide()
             self._resultGrid.remove(label)
 
-    def _retrieveImageFromUrl(self, url):
-        if url not in ["soundcloud_default.png"]:
-            name = os.getcwd()
-            split = url.split('/')
-            name = os.path.join(name, "data", split[-2] + "_" + split[-1])
-            urllib.urlretrieve(url, name)
-        else:
-            name = os.path.join(os.getcwd(), url)
-        return name
-
-    def _getImage(self, entry, _row, _col):
-        name = self._retrieveImageFromUrl(entry.thumbnail_urls[0])
-        im = Gtk.Image.new_from_file(name)
+    def _thumbnailReadyCb(self, pixbuf, entry, _row, _col):
+        im = Gtk.Image.new_from_pixbuf(pixbuf)
         box = Gtk.EventBox()
 
         box.add(im)
@@ -116,7 +138,7 @@ class Crawler(Gtk.Application):
         box.set_events(Gdk.EventMask.ALL_EVENTS_MASK)
         box.connect("button-press-event", self._imageClickedCb, entry)
 
-        GLib.idle_add(self._packBox, box, im, _row, _col, entry)
+        self._packBox(box, im, _row, _col, entry)
 
     def _packBox(self, box, image, _row, _col, entry):
         self._gridLock.acquire()
@@ -133,62 +155,223 @@ class Crawler(Gtk.Application):
         image.props.window.set_cursor (Gdk.Cursor (Gdk.CursorType.HAND1))
 
     def _cleanup(self):
-        if self._alreadyPlaying:
+        if self._current_service is not None:
             self._current_service.stop_download()
-            self.pipeline.setState(Gst.State.NULL)
-
-        shutil.rmtree(os.path.join(os.getcwd(), "data"))
+        self._releaseBuffering()
+        if self.pipeline is not None:
+            self.pipeline.release()
+            # Give the sinks a chance to close before we quit
+            self.pipeline.waitStateChanges(1)
+        for download_thread in self._download_threads:
+            # Stopped downloads close their connections right away
+            download_thread.join(1)
+
+        self._prefetcher.cleanup()
+        self._thumbnailer.cleanup()
+
+        if DEBUG:
+            print "connection pool :", http_pool.get_default_pool().getStats()
+            print "seconds waiting for bandwidth :", bandwidth.get_default_scheduler().getStats()
+        http_pool.get_default_pool().closeAll()
 
     def _searchActivatedCb(self, entry):
         self._clearGrid()
-        _entries = []
+        self._thumbnailer.cancelPending()
+        info_cache.get_default_cache().cancelPending()
+        self._search_id += 1
+        self._next_cell = 0
+        self._pending_services = set(self._services)
         for service in self._services:
-            _tmp_entries = service.search(entry.get_text())
-            for _entry in _tmp_entries:
-                _entries.append(_entry)
-        _col = 0
-        _row = 0
+            thread.start_new_thread(self._searchService, (service, entry.get_text(), self._search_id))
+            GLib.timeout_add_seconds(SEARCH_DEADLINE, self._searchDeadlineCb, service, self._search_id)
+
+    def _searchService(self, service, words, search_id):
+        try:
+            _entries = service.search(words)
+        except Exception, e:
+            GLib.idle_add(self._searchFailedCb, service, search_id, e)
+            return
+        GLib.idle_add(self._searchResultsCb, service, search_id, _entries)
+
+    def _searchResultsCb(self, service, search_id, _entries):
+        if search_id != self._search_id or service not in self._pending_services:
+            # Results of an older search, or after the deadline
+            return False
+        self._pending_services.remove(service)
 
         shuffle(_entries)  # Because why not ?
+        if self._next_cell == 0:
+            self._prefetcher.prefetch(_entries)
 
         for _entry in _entries:
-            thread.start_new_thread(self._getImage, (_entry, _row, _col))
-            _row += 1
-            if (_row >= RESULT_COLUMNS):
-                _row = 0
-                _col += 1
+            _row = self._next_cell % RESULT_COLUMNS
+            _col = self._next_cell / RESULT_COLUMNS
+            # Cells on top are the visible ones, fetch them first
+            self._thumbnailer.fetch(_entry.thumbnail_urls[0], self._next_cell,
+                                    self._thumbnailReadyCb, _entry, _row, _col)
+            if self._next_cell < INFO_RESOLVE_AHEAD:
+                _entry.service.resolveAhead(_entry.media_url, self._next_cell)
+            self._next_cell += 1
+        return False
+
+    def _searchFailedCb(self, service, search_id, error):
+        if search_id == self._search_id and service in self._pending_services:
+            self._pending_services.remove(service)
+            print "search on %s failed : %s" % (service.getName(), error)
+        return False
+
+    def _searchDeadlineCb(self, service, search_id):
+        if search_id == self._search_id and service in self._pending_services:
+            self._pending_services.remove(service)
+            print "search on %s took more than %d seconds, ignoring it" % (service.getName(), SEARCH_DEADLINE)
+        return False
 
     def _onDeleteCb(self, _, dummy):
         self._cleanup()
         self.quit()
 
     def _startPlaying(self):
+        if self._alreadyPlaying:
+            # Queued by several progress updates
+            return False
         self._alreadyPlaying = True
-        name = self._current_url.split("/")[-1]
-        if self._convert_button.get_sensitive():
-            uri = GLib.filename_to_uri(os.path.join(os.getcwd(), "data", name), None)
+        if self._start_decision is not None:
+            threshold, bitrate, speed = self._start_decision
+            print "playback starts after %d bytes (threshold %d bytes, bitrate %s B/s, download speed %s B/s)" % (
+                self._available_bytes, threshold,
+                "%d" % bitrate if bitrate else "unknown", "%d" % speed if speed is not None else "unknown")
+        # Conversion can start while downloading
+        self._convert_button.set_sensitive(True)
+        if self._current_uri is not None:
+            uri = GLib.filename_to_uri(self._current_uri, None)
         else:
-            uri = GLib.filename_to_uri(os.path.join(os.getcwd(), "data", name + ".part"), None)
-        if not self._current_entry.audio_only:
-            pipe = Gst.parse_launch("uridecodebin uri=" + uri +" name=d ! xvimagesink name=my_video_sink d. ! autoaudiosink")
+            uri = GLib.filename_to_uri(self._current_tmpfilename, None)
+        self._releaseBuffering()
+        if self.pipeline is None:
+            # Kept until we quit, only the media changes from now on
+            self.pipeline = PlaybackEngine()
+            self.pipeline.connect("eos", self._eosCb)
+            self.pipeline.load(uri, self._current_entry.audio_only)
+            self.viewer.setPipeline(self.pipeline)
         else:
-            pipe = Gst.parse_launch("uridecodebin uri=" + uri + " ! tee name=t ! queue ! audioresample ! audioconvert ! synaescope shader=3 ! videoconvert ! xvimagesink name=my_video_sink t. ! queue ! audioresample ! audioconvert ! autoaudiosink")
-        pipeline = SimplePipeline(pipe, pipe.get_by_name("my_video_sink"))
-        pipeline.connect("eos", self._eosCb)
-        if self.pipeline:
-            self.pipeline.setState(Gst.State.NULL)
-        self.pipeline = pipeline
-        self.viewer.setPipeline(pipeline)
-        self.viewer._playButtonCb(None, None)
+            self.pipeline.load(uri, self._current_entry.audio_only)
+        if self._current_uri is None:
+            self._buffering = buffering.BufferingSupervisor(self.pipeline, self._getAvailable)
+            self._buffering.notifyProgress(self._total_bytes, self._download_speed)
+            self._buffering.connect("stalled", self._stalledCb)
+            self._buffering.connect("resumed", self._resumedCb)
+        # Queued behind the switch, which runs off the main loop
+        self.pipeline.play()
 
     def _eosCb(self, pipeline):
+        if self._buffering is not None and self._current_uri is None:
+            # It waits for the download
+            return
         print "pipeline has got to EOS !"
 
-    def _progress_hook(self, status):
+    def _stalledCb(self, supervisor, position):
+        print "playback stalled at %s, waiting for the download" % print_ns(position)
+
+    def _resumedCb(self, supervisor, duration):
+        stats = supervisor.getStats()
+        print "playback resumed after %.1f seconds, %d stalls for %.1f seconds so far" % (
+            duration, stats["stalls"], stats["stalled_time"])
+
+    def _releaseBuffering(self):
+        if self._buffering is not None:
+            stats = self._buffering.getStats()
+            if stats["stalls"]:
+                print "playback stalled %d times for %.1f seconds, %.1f at most" % (
+                    stats["stalls"], stats["stalled_time"], stats["longest_stall"])
+            self._buffering.release()
+            self._buffering = None
+
+    def seek(self, position, format=Gst.Format.TIME):
+        """
+        Seeks the pipeline once the bytes around position are downloaded,
+        they are fetched before the rest of the media if they were not.
+        """
+        if self.pipeline is None:
+            return
+        playing = self.pipeline.getState() == Gst.State.PLAYING
+        if self._buffering is not None:
+            # Paused by it, but playing as far as the user knows
+            playing = playing or self._buffering.isStalled()
+            self._buffering.seeked(position)
+        offset = self._estimateOffset(position, format)
+        if offset is not None:
+            self._downloader.prioritize(offset)
+            if not self._isDownloaded(offset):
+                self._pending_seek = (position, format, playing)
+                self.pipeline.pause()
+                return
+        self._pending_seek = None
+        self.pipeline.simple_seek(position, format)
+
+    def _estimateOffset(self, position, format):
+        """
+        Returns the byte of the downloading media at position, assuming a
+        constant bitrate, or None if the whole media is there.
+        """
+        if self._current_uri is not None or not self._total_bytes:
+            return None
+        if format == Gst.Format.BYTES:
+            return position
+        try:
+            duration = self.pipeline.getDuration()
+        except PipelineError:
+            return None
+        if not duration or duration == Gst.CLOCK_TIME_NONE:
+            return None
+        return min(self._total_bytes - 1, self._total_bytes * position / duration)
+
+    def _isDownloaded(self, offset):
+        threshold = buffering.get_start_threshold(self._total_bytes - offset, self._getBitrate(),
+                                                  self._download_speed)
+        return self._getAvailable(offset) >= threshold
+
+    def _getAvailable(self, offset):
+        available = self._downloader.get_available(offset)
+        if available is None:
+            # Downloaded in order
+            available = max(0, self._available_bytes - offset)
+        return available
+
+    def _getBitrate(self):
+        return buffering.get_bitrate(self._total_bytes, self._current_entry.duration)
+
+    def _pendingSeekCb(self):
+        if self._pending_seek is None:
+            return False
+        position, format, playing = self._pending_seek
+        offset = self._estimateOffset(position, format)
+        if offset is not None and not self._isDownloaded(offset):
+            return False
+        self._pending_seek = None
+        try:
+            self.pipeline.simple_seek(position, format)
+        except PipelineError, e:
+            print "seek failed : %s" % e
+            return False
+        if playing:
+            self.pipeline.play()
+        return False
+
+    def _progress_hook(self, downloader, status):
+        if downloader is not self._downloader:
+            # Late update of a download that was replaced
+            return
         if status["status"] == "finished":
             self._convert_button.set_sensitive(True)
             self._keep_button.set_sensitive(True)
-            self._current_uri = os.path.join(os.getcwd(), "data", status["filename"])
+            self._current_uri = status["filename"]
+            if self._buffering is not None:
+                self._buffering.finish()
+            if self._pending_seek is not None:
+                GLib.idle_add(self._pendingSeekCb)
+            if self._streaming_job is not None:
+                self._streaming_job.source.finish()
+                self._streaming_job = None
             if not self._alreadyPlaying:
                 GLib.idle_add(self._startPlaying)
             return
@@ -196,43 +379,167 @@ class Crawler(Gtk.Application):
         try:
             _bytes = status["downloaded_bytes"]
             _total = status["total_bytes"]
+            self._current_tmpfilename = status["tmpfilename"]
         except KeyError:
             return
-
-        if _bytes > MINIMUM_DOWNLOADED_SIZE and not self._alreadyPlaying:
-            GLib.idle_add(self._startPlaying)
-
-        GLib.idle_add(self._update_bytes_labels, _bytes, _total)
-
-    def _update_bytes_labels(self, _bytes, _total):
+        self._total_bytes = _total
+        speed = status.get("speed")
+        if speed is None and status.get("eta") and _total:
+            speed = float(_total - _bytes) / status["eta"]
+        if speed is not None:
+            self._download_speed = speed
+        if self._buffering is not None:
+            self._buffering.notifyProgress(_total, self._download_speed)
+
+        # Segmented downloads fill the file out of order, only the head is playable
+        self._available_bytes = status.get("contiguous_bytes", _bytes)
+        if self._streaming_job is not None:
+            self._streaming_job.source.notifyProgress(self._available_bytes)
+
+        if not self._alreadyPlaying:
+            bitrate = self._getBitrate()
+            threshold = buffering.get_start_threshold(_total, bitrate, self._download_speed)
+            if DEBUG:
+                print "playback start threshold : %d bytes, %d downloaded" % (threshold, self._available_bytes)
+            if self._available_bytes >= threshold:
+                self._start_decision = (threshold, bitrate, self._download_speed)
+                GLib.idle_add(self._startPlaying)
+        if self._pending_seek is not None:
+            GLib.idle_add(self._pendingSeekCb)
+
+        # Only one update of the labels waits in the main loop at a time
+        self._bytes_counts = (_bytes, _total)
+        if not self._bytes_update_queued:
+            self._bytes_update_queued = True
+            GLib.idle_add(self._update_bytes_labels)
+
+    def _update_bytes_labels(self):
+        self._bytes_update_queued = False
+        _bytes, _total = self._bytes_counts
         self._downloaded_label.set_text(str(_bytes) + " downloaded")
         self._total_label.set_text(str(_total) + " total")
 
     def togglePlayback(self):
         self.pipeline.togglePlayback()
 
-    def _download_url(self, entry):
-        self._current_url = entry.media_url
-        self._current_entry = entry
-        entry.service.downloadUrl(entry.media_url, self._progress_hook)
+    def _download_url(self, entry, downloader, hook):
+        self._prefetcher.claim(entry.media_url)
+        error = "the download did not complete"
+        try:
+            if entry.service.downloadUrl(entry.media_url, hook, downloader=downloader):
+                error = None
+        except Exception, e:
+            # An expired URL, or the connection was lost for good
+            error = e
+        finally:
+            GLib.idle_add(self._downloadEndedCb, entry, downloader, error)
+
+    def _downloadEndedCb(self, entry, downloader, error):
+        if self._current_entry is not entry or self._current_uri is not None:
+            # Another media was picked meanwhile, or this one is complete
+            return False
+        if downloader.is_stopped():
+            return False
+        print "download of %s failed : %s" % (entry.title, error)
+        if self._streaming_job is not None:
+            # Its source would wait for bytes forever
+            self._converter_queue.cancel(self._streaming_job)
+            self._streaming_job = None
+        if self._buffering is not None:
+            # Play what was downloaded instead of staying stalled
+            self._buffering.finish()
+        return False
 
     def _imageClickedCb(self, widget, event, entry):
         if self._alreadyPlaying:
-            self.viewer._playButtonCb(None, None)
+            self.pipeline.pause()
+        if self._current_service is not None:
+            # Even if it did not start playing yet
             self._current_service.stop_download()
 
+        if self._streaming_job is not None:
+            self._converter_queue.cancel(self._streaming_job)
+            self._streaming_job = None
+        # Progress of the next download is not about what is being played
+        self._releaseBuffering()
+
         self._current_service = entry.service
+        self._current_url = entry.media_url
+        self._current_entry = entry
+        self._current_uri = None
+        self._available_bytes = 0
+        self._total_bytes = None
+        self._download_speed = None
+        self._start_decision = None
+        self._pending_seek = None
         self._convert_button.set_sensitive(False)
         self._keep_button.set_sensitive(False)
         self._alreadyPlaying = False
-        thread.start_new_thread(self._download_url, (entry,))
+        downloader = entry.service.createDownloader()
+        self._downloader = downloader
+        # Tells the updates of this download from the ones of the replaced
+        # downloads, which may still arrive
+        hook = functools.partial(self._progress_hook, downloader)
+        downloader.add_progress_hook(hook)
+        download_thread = threading.Thread(target=self._download_url, args=(entry, downloader, hook))
+        download_thread.daemon = True
+        download_thread.start()
+        self._download_threads = [t for t in self._download_threads if t.is_alive()]
+        self._download_threads.append(download_thread)
+        if DEBUG:
+            print "%d downloads running" % len(self._download_threads)
         self._updateStateBox(entry)
 
     def _convertMediaCb(self, _):
-        self._converter_queue.enqueue(self._current_uri, self._current_entry.title)
+        # Comparing the formats may have to extract the infos again
+        thread.start_new_thread(self._chooseConversionSource, (self._current_entry,))
+
+    def _chooseConversionSource(self, entry):
+        if entry.audio_only and entry.service.sharesFormat(entry.media_url, CONVERT):
+            GLib.idle_add(self._convertPlayedMedia, entry)
+        else:
+            # The played video or lower bitrate audio would be thrown away
+            self._downloadForConversion(entry)
+
+    def _convertPlayedMedia(self, entry):
+        if entry is not self._current_entry:
+            # Another media was picked meanwhile, the file is in the media cache
+            thread.start_new_thread(self._downloadForConversion, (entry,))
+        elif self._current_uri is not None:
+            self._converter_queue.enqueue(self._current_uri, entry.title)
+        elif self._streaming_job is None:
+            # Encode from the growing download rather than waiting for it to finish
+            self._streaming_job = self._converter_queue.enqueueGrowing(
+                self._current_tmpfilename, entry.title, self._available_bytes)
+        return False
+
+    def _downloadForConversion(self, entry):
+        def hook(status):
+            if status["status"] == "finished":
+                GLib.idle_add(self._enqueueConversion, status["filename"], entry.title)
+        entry.service.downloadUrl(entry.media_url, hook, CONVERT)
+
+    def _enqueueConversion(self, path, title):
+        self._converter_queue.enqueue(path, title)
+        return False
+
+    def _conversionJobChangedCb(self, queue, job):
+        if job.error:
+            print "conversion to %s %s : %s" % (job.target, job.status, job.error)
+        elif job.mode:
+            print "conversion to %s %s (%s)" % (job.target, job.status, job.mode)
+        else:
+            print "conversion to %s %s" % (job.target, job.status)
 
     def _keepMediaCb(self, _):
-        shutil.copy(self._current_uri, os.path.join(VIDEO_DIRECTORY, self._current_entry.title))
+        thread.start_new_thread(self._downloadToKeep, (self._current_entry,))
+
+    def _downloadToKeep(self, entry):
+        # What was played is the smallest format, keep the best one
+        def hook(status):
+            if status["status"] == "finished":
+                shutil.copy(status["filename"], os.path.join(VIDEO_DIRECTORY, entry.title))
+        entry.service.downloadUrl(entry.media_url, hook, KEEP)
 
 if __name__=="__main__":
     Gtk.init([])
@@ -0,0 +1,78 @@
+"""
+Parsing of HLS (m3u8) playlists, for the native HLS downloader of
+L{FileDownloader}.
+"""
+import re
+import urlparse
+
+ATTRIBUTE_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+class Segment(object):
+    def __init__(self, url, duration):
+        self.url = url
+        self.duration = duration
+
+
+class Playlist(object):
+    """
+    @ivar variants: (bandwidth, url) tuples if this is a master playlist
+    @ivar segments: The media segments, the initialization section of
+    fragmented MP4 streams first
+    @ivar ended: False for live streams, whose playlist keeps growing
+    @ivar supported: False if the native downloader can't handle the
+    stream, because it is encrypted or split in byte ranges
+    """
+
+    def __init__(self):
+        self.variants = []
+        self.segments = []
+        self.ended = False
+        self.supported = True
+        self.fragmented_mp4 = False
+
+    def getBestVariant(self):
+        return max(self.variants)[1]
+
+
+def parse_attributes(line):
+    attributes = {}
+    for name, value in ATTRIBUTE_RE.findall(line.split(":", 1)[1]):
+        attributes[name] = value.strip('"')
+    return attributes
+
+
+def parse_playlist(text, base_url):
+    playlist = Playlist()
+    duration = None
+    variant_bandwidth = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            variant_bandwidth = int(parse_attributes(line).get("BANDWIDTH", 0))
+        elif line.startswith("#EXTINF:"):
+            duration = float(line[len("#EXTINF:"):].split(",")[0] or 0)
+        elif line.startswith("#EXT-X-KEY:"):
+            if parse_attributes(line).get("METHOD", "NONE") != "NONE":
+                playlist.supported = False
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            playlist.supported = False
+        elif line.startswith("#EXT-X-MAP:"):
+            attributes = parse_attributes(line)
+            if "BYTERANGE" in attributes:
+                playlist.supported = False
+            playlist.fragmented_mp4 = True
+            playlist.segments.append(Segment(urlparse.urljoin(base_url, attributes["URI"]), 0))
+        elif line.startswith("#EXT-X-ENDLIST"):
+            playlist.ended = True
+        elif line.startswith("#"):
+            continue
+        elif variant_bandwidth is not None:
+            playlist.variants.append((variant_bandwidth, urlparse.urljoin(base_url, line)))
+            variant_bandwidth = None
+        else:
+            playlist.segments.append(Segment(urlparse.urljoin(base_url, line), duration))
+            duration = None
+    return playlist
@@ -0,0 +1,337 @@
+"""
+Keep-alive HTTP connections shared by media downloads, thumbnails and
+metadata extraction.
+
+urllib2 closes its connection after every request, this module provides
+handlers that check connections out of a per host pool instead, and put
+them back once the response body has been fully read.
+"""
+import httplib
+import socket
+import thread
+import time
+import urllib2
+
+import bandwidth
+from config import HTTP_POOL_MAX_IDLE_PER_HOST, HTTP_POOL_MAX_IDLE, HTTP_POOL_IDLE_TIMEOUT
+
+try:
+    from youtube_dl.utils import YoutubeDLHandler
+except ImportError:
+    YoutubeDLHandler = None
+
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections, indexed by (scheme, host).
+
+    @ivar hits: Number of requests served by an idle connection
+    @ivar misses: Number of requests that needed a new connection
+    @ivar evictions: Number of idle connections closed by the pool
+    """
+
+    def __init__(self, max_idle_per_host=HTTP_POOL_MAX_IDLE_PER_HOST,
+                 max_idle=HTTP_POOL_MAX_IDLE, idle_timeout=HTTP_POOL_IDLE_TIMEOUT):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = thread.allocate_lock()
+        self._idle = {}
+
+    def acquire(self, scheme, host, timeout):
+        """
+        Returns a (connection, reused) tuple for the given host.
+        """
+        self._lock.acquire()
+        try:
+            self._evictExpired(time.time())
+            connections = self._idle.get((scheme, host))
+            if connections:
+                self.hits += 1
+                return connections.pop()[0], True
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, timeout=timeout), False
+        return httplib.HTTPConnection(host, timeout=timeout), False
+
+    def release(self, scheme, host, connection):
+        """
+        Gives back a connection whose last response has been fully read.
+        """
+        self._lock.acquire()
+        try:
+            connections = self._idle.setdefault((scheme, host), [])
+            if len(connections) >= self.max_idle_per_host or \
+                    self._countIdle() >= self.max_idle:
+                self.evictions += 1
+                connection.close()
+                return
+            connections.append((connection, time.time()))
+        finally:
+            self._lock.release()
+
+    def closeAll(self):
+        self._lock.acquire()
+        try:
+            for connections in self._idle.itervalues():
+                for connection, unused_last_used in connections:
+                    connection.close()
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        self._lock.acquire()
+        try:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "idle": self._countIdle()}
+        finally:
+            self._lock.release()
+
+    def _countIdle(self):
+        return sum(len(connections) for connections in self._idle.itervalues())
+
+    def _evictExpired(self, now):
+        for key, connections in self._idle.items():
+            alive = []
+            for connection, last_used in connections:
+                if now - last_used > self.idle_timeout:
+                    self.evictions += 1
+                    connection.close()
+                else:
+                    alive.append((connection, last_used))
+            if alive:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+
+
+class PooledResponse(object):
+    """
+    File-like HTTP response, puts its connection back in the pool once
+    the body has been consumed.
+    """
+
+    def __init__(self, pool, scheme, host, connection, response, url):
+        self._pool = pool
+        self._scheme = scheme
+        self._host = host
+        self._connection = connection
+        self._response = response
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self.url = url
+        self._aborted = False
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def read(self, amt=None):
+        if self._response is None:
+            return ''
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._done()
+        self._charge(len(data))
+        return data
+
+    def readinto(self, buf):
+        """
+        Receives directly into buf when the body length is known and
+        nothing is left in the socket file buffer.
+        """
+        response = self._response
+        if response is None:
+            return 0
+        sock = getattr(response.fp, "_sock", None)
+        if response.chunked or response.length is None or sock is None or \
+                self._hasBufferedData(response.fp):
+            data = self.read(len(buf))
+            buf[:len(data)] = data
+            return len(data)
+
+        read = sock.recv_into(buf, min(len(buf), response.length))
+        response.length -= read
+        if not read or not response.length:
+            if not read:
+                # Premature EOF, do not reuse the connection
+                response.will_close = True
+            response.close()
+            self._done()
+        self._charge(read)
+        return read
+
+    def _charge(self, amount):
+        if amount:
+            bandwidth.get_default_scheduler().consume(bandwidth.get_thread_class(), amount)
+
+    def _hasBufferedData(self, fp):
+        rbuf = getattr(fp, "_rbuf", None)
+        if rbuf is None:
+            return True
+        rbuf.seek(0, 2)
+        return rbuf.tell() > 0
+
+    def readline(self, limit=-1):
+        line = []
+        while limit < 0 or len(line) < limit:
+            char = self.read(1)
+            if not char:
+                break
+            line.append(char)
+            if char == '\n':
+                break
+        return ''.join(line)
+
+    def abort(self):
+        """
+        Interrupts a read blocked in another thread, the connection gets
+        closed instead of going back to the pool.
+        """
+        if self._response is None:
+            # The connection may already serve another response
+            return
+        self._aborted = True
+        sock = self._connection.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def isDone(self):
+        """
+        Returns True once the body was read or the response closed.
+        """
+        return self._response is None
+
+    def close(self):
+        if self._response is None:
+            return
+        if not self._response.isclosed():
+            # Unread data left on the socket, the connection can't be reused
+            self._response.close()
+            self._connection.close()
+            self._response = None
+            return
+        self._done()
+
+    def _done(self):
+        if self._response is None:
+            return
+        if self._response.will_close or self._aborted:
+            self._connection.close()
+        else:
+            self._pool.release(self._scheme, self._host, self._connection)
+        self._response = None
+
+
+class PooledHTTPHandler(urllib2.BaseHandler):
+    """
+    urllib2 handler opening http and https URLs on pooled connections.
+    """
+    # Run before the default handlers
+    handler_order = 400
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def http_open(self, req):
+        return self._open(req, "http")
+
+    def https_open(self, req):
+        return self._open(req, "https")
+
+    def _open(self, req, scheme):
+        if req._tunnel_host:
+            # Let the default handlers deal with proxy tunnels
+            return None
+
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        while True:
+            connection, reused = self._pool.acquire(scheme, host, req.timeout)
+            if reused:
+                # The connection may have been opened with another timeout
+                if req.timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                    connection.sock.settimeout(socket.getdefaulttimeout())
+                else:
+                    connection.sock.settimeout(req.timeout)
+            try:
+                connection.request(req.get_method(), req.get_selector(), req.data, headers)
+                response = connection.getresponse(buffering=True)
+                break
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                # The server may have dropped an idle connection, only
+                # retry on those.
+                if not reused:
+                    raise urllib2.URLError(e)
+
+        return PooledResponse(self._pool, scheme, host, connection,
+                              response, req.get_full_url())
+
+
+_pool = ConnectionPool()
+_handler = PooledHTTPHandler(_pool)
+if YoutubeDLHandler is not None:
+    _opener = urllib2.build_opener(_handler, YoutubeDLHandler())
+else:
+    _opener = urllib2.build_opener(_handler)
+
+
+def get_default_pool():
+    return _pool
+
+
+def install(ydl):
+    """
+    Makes the given YoutubeDL instance fetch its pages through the
+    shared pool.
+    """
+    opener = getattr(ydl, "_opener", None)
+    if opener is not None:
+        opener.add_handler(_handler)
+
+
+def urlopen(request, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    return _opener.open(request, timeout=timeout)
+
+
+def urlretrieve(url, filename):
+    """
+    Pooled replacement for urllib.urlretrieve.
+    """
+    response = urlopen(url)
+    try:
+        with open(filename, "wb") as f:
+            while True:
+                block = response.read(65536)
+                if not block:
+                    break
+                f.write(block)
+    finally:
+        response.close()
+    return filename
@@ -0,0 +1,134 @@
+"""
+Cache of the infos extract_info returns for media pages.
+
+Extraction is often the slowest step before a download starts. Infos are
+kept per page URL until the signed media URLs they contain expire,
+concurrent extractions of a same page are shared, and pages can be
+resolved ahead of time by background workers.
+"""
+import itertools
+import Queue
+import re
+import thread
+import threading
+import time
+
+from collections import OrderedDict
+
+import bandwidth
+import singleflight
+from loggable import Loggable
+from config import INFO_CACHE_TTL, INFO_CACHE_ENTRIES, INFO_RESOLVER_WORKERS
+
+# Signed URLs carry their expiry date, as "expire" on YouTube and
+# "Expires" on CloudFront, which SoundCloud uses
+EXPIRE_RE = re.compile(r"[?&](?:expire|Expires)=(\d+)")
+# Forget infos this number of seconds before their URLs expire, so that a
+# download has time to start
+EXPIRE_MARGIN = 60
+
+
+class InfoCache(Loggable):
+    def __init__(self, ttl=INFO_CACHE_TTL, max_entries=INFO_CACHE_ENTRIES,
+                 workers=INFO_RESOLVER_WORKERS):
+        Loggable.__init__(self)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = thread.allocate_lock()
+        # url -> (expires, infos), least recently used first
+        self._entries = OrderedDict()
+        self._flights = singleflight.Group()
+        self._queue = Queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._generation = 0
+
+        for unused_i in range(workers):
+            worker = threading.Thread(target=self._run)
+            worker.daemon = True
+            worker.start()
+
+    def get(self, url, extract):
+        """
+        Returns the infos of the page at url, calling extract() to get them
+        if they are not cached or about to expire.
+        """
+        infos = self._lookup(url)
+        if infos is not None:
+            return infos
+        return self._flights.do(url, lambda: self._extract(url, extract))
+
+    def _lookup(self, url):
+        self._lock.acquire()
+        try:
+            cached = self._entries.pop(url, None)
+            if cached is not None and cached[0] > time.time():
+                self._entries[url] = cached
+                return cached[1]
+            return None
+        finally:
+            self._lock.release()
+
+    def _extract(self, url, extract):
+        # Stored by an extraction that ended since the lookup
+        infos = self._lookup(url)
+        if infos is None:
+            infos = extract()
+            self._store(url, infos)
+        return infos
+
+    def resolveAhead(self, url, extract, priority=0):
+        """
+        Extracts the infos of url in the background, lowest priority first,
+        unless L{cancelPending} is called before a worker gets to it.
+        """
+        self._queue.put((priority, self._counter.next(), self._generation, url, extract))
+
+    def cancelPending(self):
+        self._generation += 1
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Queue.Empty:
+                break
+
+    def invalidate(self, url):
+        """
+        Forgets the infos of url, for example because its media URL was
+        refused.
+        """
+        self._lock.acquire()
+        self._entries.pop(url, None)
+        self._lock.release()
+
+    def _run(self):
+        bandwidth.set_thread_class(bandwidth.BACKGROUND)
+        while True:
+            unused_priority, unused_count, generation, url, extract = self._queue.get()
+            if generation != self._generation:
+                continue
+            try:
+                self.get(url, extract)
+            except Exception, e:
+                self.warning("Could not resolve %s: %s", url, e)
+
+    def _store(self, url, infos):
+        expires = self._getExpiry(infos)
+        self._lock.acquire()
+        try:
+            self._entries[url] = (expires, infos)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def _getExpiry(self, infos):
+        expires = time.time() + self.ttl
+        for entry in infos.get("entries") or [infos]:
+            for format in entry.get("formats") or [entry]:
+                match = EXPIRE_RE.search(format.get("url") or "")
+                if match:
+                    expires = min(expires, int(match.group(1)) - EXPIRE_MARGIN)
+        return expires
+
+
+get_default_cache = singleflight.once(InfoCache)
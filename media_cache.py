@@ -0,0 +1,195 @@
+"""
+Persistent cache of downloaded media.
+
+Files are named after a hash of the page URL and the format that was
+downloaded, an index file keeps their size and last access time so that
+lookups never need to scan the directory.
+
+Downloads that did not complete leave their temporary files there too,
+eviction counts them and removes them oldest first along with the least
+recently used media.
+
+Page URLs are used rather than the resolved media URLs, as the latter
+embed signatures that change every time a page is extracted.
+"""
+import hashlib
+import json
+import os
+import stat
+import thread
+import time
+
+import singleflight
+from config import MEDIA_CACHE_DIRECTORY, MEDIA_CACHE_SIZE, MEDIA_CACHE_PARTIAL_GRACE
+
+INDEX_NAME = "index.json"
+
+
+class MediaCache(object):
+    def __init__(self, directory=MEDIA_CACHE_DIRECTORY, max_size=MEDIA_CACHE_SIZE,
+                 partial_grace=MEDIA_CACHE_PARTIAL_GRACE):
+        self.directory = directory
+        self.max_size = max_size
+        self.partial_grace = partial_grace
+        self._lock = thread.allocate_lock()
+        self._index_path = os.path.join(directory, INDEX_NAME)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._entries = self._loadIndex()
+        # What earlier runs left behind may already be too much
+        if self._evict(keep=None):
+            self._saveIndex()
+
+    def pathFor(self, url, format_id, ext):
+        """
+        Returns the path a media should be downloaded to, the downloader
+        writes to path + ".part" and renames it once complete.
+        """
+        key = self._makeKey(url, format_id)
+        return os.path.join(self.directory, key + "." + (ext or "media"))
+
+    def lookup(self, url, format_id=None, purpose=None):
+        """
+        Returns the path of a complete cached file for url, or None.
+
+        If format_id is None, the most recently used format that was
+        downloaded for purpose, or for anything if purpose is None too,
+        is returned.
+        """
+        self._lock.acquire()
+        try:
+            if format_id is not None:
+                candidates = [self._entries.get(self._makeKey(url, format_id))]
+            else:
+                candidates = sorted((entry for entry in self._entries.itervalues()
+                                     if entry["url"] == url and
+                                     purpose in (None, entry.get("purpose"))),
+                                    key=lambda entry: entry["last_used"],
+                                    reverse=True)
+            for entry in candidates:
+                if entry is None:
+                    continue
+                path = os.path.join(self.directory, entry["filename"])
+                if not os.path.isfile(path):
+                    # Removed behind our back
+                    del self._entries[self._makeKey(entry["url"], entry["format_id"])]
+                    self._saveIndex()
+                    continue
+                entry["last_used"] = time.time()
+                self._saveIndex()
+                return path
+            return None
+        finally:
+            self._lock.release()
+
+    def add(self, url, format_id, path, purpose=None):
+        """
+        Registers a complete file returned by L{pathFor}, and evicts the least
+        recently used entries if the cache got too big.
+        """
+        self._lock.acquire()
+        try:
+            key = self._makeKey(url, format_id)
+            self._entries[key] = {"url": url,
+                                  "format_id": format_id,
+                                  "purpose": purpose,
+                                  "filename": os.path.basename(path),
+                                  "size": os.path.getsize(path),
+                                  "last_used": time.time()}
+            self._evict(keep=key)
+            self._saveIndex()
+        finally:
+            self._lock.release()
+
+    def getSize(self):
+        """
+        Returns the bytes used by the complete media and by the files of
+        unfinished downloads.
+        """
+        self._lock.acquire()
+        try:
+            return sum(entry["size"] for entry in self._entries.itervalues()) + \
+                sum(size for size, unused_mtime, unused_paths in self._listPartials().itervalues())
+        finally:
+            self._lock.release()
+
+    def _makeKey(self, url, format_id):
+        return hashlib.sha1(("%s\0%s" % (url, format_id)).encode("utf-8")).hexdigest()
+
+    def _listPartials(self):
+        """
+        Returns the files that are not complete media, .part files and the
+        state saved next to them, as {key: (size, mtime, paths)}.
+        """
+        complete = set(entry["filename"] for entry in self._entries.itervalues())
+        partials = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return partials
+        for name in names:
+            if name in complete or name.startswith(INDEX_NAME):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            # Named after the media they are downloading, key.ext.part...
+            key = name.split(".", 1)[0]
+            size, mtime, paths = partials.get(key, (0, 0, []))
+            partials[key] = (size + st.st_size, max(mtime, st.st_mtime), paths + [path])
+        return partials
+
+    def _evict(self, keep):
+        """
+        Removes the least recently used media and unfinished downloads until
+        the cache fits in max_size, never the media keep. Returns whether
+        entries were removed from the index.
+        """
+        partials = self._listPartials()
+        total = sum(entry["size"] for entry in self._entries.itervalues()) + \
+            sum(size for size, unused_mtime, unused_paths in partials.itervalues())
+        if total <= self.max_size:
+            return False
+
+        candidates = [(entry["last_used"], key, entry["size"],
+                       [os.path.join(self.directory, entry["filename"])])
+                      for key, entry in self._entries.iteritems() if key != keep]
+        # A running download keeps writing to its files
+        recent = time.time() - self.partial_grace
+        candidates.extend((mtime, None, size, paths)
+                          for size, mtime, paths in partials.itervalues() if mtime < recent)
+        removed = False
+        for unused_time, key, size, paths in sorted(candidates):
+            if total <= self.max_size:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            if key is not None:
+                del self._entries[key]
+                removed = True
+        return removed
+
+    def _loadIndex(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _saveIndex(self):
+        # Write then rename, so that a crash never leaves a truncated index
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f)
+        os.rename(tmp_path, self._index_path)
+
+
+get_default_cache = singleflight.once(MediaCache)
@@ -8,6 +8,23 @@ class MediaEntry(object):
         self._service = service
         self._audio_only = audio_only
 
+    def serialize(self):
+        """
+        Returns the entry as a dict that can be saved as JSON, without its service.
+        """
+        return {"media_url": self._media_url,
+                "thumbnail_urls": self._thumbnail_urls,
+                "title": self._title,
+                "duration": self._duration,
+                "description": self._description,
+                "audio_only": self._audio_only}
+
+    @classmethod
+    def deserialize(cls, data, service):
+        return cls(data["media_url"], data["thumbnail_urls"], data["title"],
+                   data["duration"], data["description"], service,
+                   audio_only=data["audio_only"])
+
     @property
     def thumbnail_urls(self):
         return self._thumbnail_urls
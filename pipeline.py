@@ -26,6 +26,11 @@
 """
 High-level pipelines
 """
+import Queue
+import thread
+import threading
+
+import singleflight
 from loggable import Loggable
 from signallable import Signallable
 from misc import print_ns
@@ -34,6 +39,10 @@ from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gst
 
+# Nanoseconds a queued seek waits for the pipeline to preroll
+QUEUED_SEEK_TIMEOUT = 5 * Gst.SECOND
+
+
 # FIXME : define/document a proper hierarchy
 class PipelineError(Exception):
     pass
@@ -124,6 +133,34 @@ class Seeker(Signallable, Loggable):
         return False
 
 
+class StateChangeWorker(Loggable):
+    """
+    Thread running the state changes that can block for long, such as
+    shutting down decoders, in the order they were requested.
+    """
+
+    def __init__(self):
+        Loggable.__init__(self)
+        self._queue = Queue.Queue()
+        worker = threading.Thread(target=self._run)
+        worker.daemon = True
+        worker.start()
+
+    def push(self, function, *args):
+        self._queue.put((function, args))
+
+    def _run(self):
+        while True:
+            function, args = self._queue.get()
+            try:
+                function(*args)
+            except Exception, e:
+                self.error("state change failed: %s", e)
+
+
+get_default_state_worker = singleflight.once(StateChangeWorker)
+
+
 class SimplePipeline(Signallable, Loggable):
     """
     The Pipeline is only responsible for:
@@ -159,6 +196,12 @@ class SimplePipeline(Signallable, Loggable):
         self._listeningSigId = 0
         self._duration = Gst.CLOCK_TIME_NONE
         self.video_overlay = video_overlay
+        # State changes queued on the worker and not done yet, counted by
+        # the worker itself so that it works without a main loop
+        self._async_pending = 0
+        self._async_lock = thread.allocate_lock()
+        self._async_idle = threading.Event()
+        self._async_idle.set()
 
     def release(self):
         """
@@ -168,15 +211,18 @@ class SimplePipeline(Signallable, Loggable):
         Call this method when the L{Pipeline} is no longer used. Forgetting to do
         so will result in memory loss.
 
+        The pipeline is set to NULL by the state change worker, C{state-change}
+        is emitted once it is done.
+
         @postcondition: The L{Pipeline} will no longer be usable.
         """
         self.deactivatePositionListener()
         self._bus.disconnect_by_func(self._busMessageCb)
         self._bus.remove_signal_watch()
-
-        self._pipeline.set_state(Gst.State.NULL)
         self._bus = None
 
+        self.setStateAsync(Gst.State.NULL)
+
     def flushSeek(self):
         self.pause()
         try:
@@ -188,16 +234,43 @@ class SimplePipeline(Signallable, Loggable):
         """
         Set the L{Pipeline} to the given state.
 
+        While state changes queued by L{setStateAsync} run, this one is
+        queued behind them rather than making the main loop wait, a failure
+        is then reported by the C{error} signal.
+
         @raises PipelineError: If the C{Gst.Pipeline} could not be changed to
-        the requested state.
+        the requested state, when no state change was queued.
         """
         self.debug("state:%r" % state)
+        if self._async_pending:
+            self.debug("queued behind %d state changes" % self._async_pending)
+            self.setStateAsync(state)
+            return
         res = self._pipeline.set_state(state)
         if res == Gst.StateChangeReturn.FAILURE:
             # reset to NULL
             self._pipeline.set_state(Gst.State.NULL)
             raise PipelineError("Failure changing state of the Gst.Pipeline to %r, currently reset to NULL" % state)
 
+    def setStateAsync(self, state):
+        """
+        Set the L{Pipeline} to the given state from the state change worker,
+        so that the main loop does not wait for the elements to shut down.
+
+        C{state-change} is emitted from the main loop once the state is
+        reached, C{error} if it could not be.
+        """
+        self._runAsync(self._changeState, state)
+
+    def waitStateChanges(self, timeout=None):
+        """
+        Waits for the state changes queued on the worker to be done.
+
+        @return: False if they are still running after timeout seconds.
+        """
+        self._async_idle.wait(timeout)
+        return self._async_idle.is_set()
+
     def getState(self):
         """
         Query the L{Pipeline} for the current state.
@@ -342,21 +415,60 @@ class SimplePipeline(Signallable, Loggable):
         """
         Seeks in the L{Pipeline} to the given position.
 
+        While state changes queued by L{setStateAsync} run, the seek is
+        queued behind them, so that it applies to the media they switch
+        to, and a failure is only logged.
+
         @param position: Position to seek to
         @type position: L{long}
         @param format: The C{Format} of the seek position
         @type format: C{Gst.Format}
-        @raise PipelineError: If seek failed
+        @raise PipelineError: If seek failed, when no state change was queued
         """
         if format == Gst.Format.TIME:
             self.debug("position : %s" % print_ns(position))
         else:
             self.debug("position : %d , format:%d" % (position, format))
 
+        if self._async_pending:
+            self._runAsync(self._queuedSeek, position, format)
+            return
+
         # clamp between [0, duration]
         if format == Gst.Format.TIME:
             position = max(0, min(position, self.getDuration()) - 1)
+        self._seek(position, format)
+        self.emit('position', position)
+
+    def seekRelative(self, time):
+        if not time:
+            self.error("Trying to seek to an invalid time: %s", time)
+            return
+        seekvalue = max(0, min(self.getPosition() + time, self.getDuration()))
+        self.simple_seek(seekvalue)
+
+    #}
+    ## Private methods
+
+    def _runAsync(self, function, *args):
+        self._async_lock.acquire()
+        self._async_pending += 1
+        self._async_idle.clear()
+        self._async_lock.release()
+        get_default_state_worker().push(self._asyncJob, function, args)
 
+    def _asyncJob(self, function, args):
+        # In the state change worker
+        try:
+            function(*args)
+        finally:
+            self._async_lock.acquire()
+            self._async_pending -= 1
+            if not self._async_pending:
+                self._async_idle.set()
+            self._async_lock.release()
+
+    def _seek(self, position, format):
         res = self._pipeline.seek(1.0, format, Gst.SeekFlags.FLUSH,
                                   Gst.SeekType.SET, position,
                                   Gst.SeekType.NONE, -1)
@@ -365,17 +477,35 @@ class SimplePipeline(Signallable, Loggable):
             raise PipelineError("seek failed")
 
         self.debug("seeking successful")
-        self.emit('position', position)
 
-    def seekRelative(self, time):
-        if not time:
-            self.error("Trying to seek to an invalid time: %s", time)
+    def _queuedSeek(self, position, format):
+        # In the state change worker. Seeking fails until the state changes
+        # queued before are done prerolling
+        self._pipeline.get_state(QUEUED_SEEK_TIMEOUT)
+        try:
+            if format == Gst.Format.TIME:
+                position = max(0, min(position, self._getDuration()) - 1)
+            self._seek(position, format)
+        except PipelineError, e:
+            self.warning("queued seek to %s failed: %s", position, e)
             return
-        seekvalue = max(0, min(self.getPosition() + time, self.getDuration()))
-        self.simple_seek(seekvalue)
+        GLib.idle_add(self._emitCb, "position", position)
 
-    #}
-    ## Private methods
+    def _changeState(self, state):
+        # In the state change worker
+        res = self._pipeline.set_state(state)
+        if res == Gst.StateChangeReturn.FAILURE:
+            self._pipeline.set_state(Gst.State.NULL)
+            GLib.idle_add(self._emitCb, "error",
+                          "Failure changing state of the Gst.Pipeline to %r, currently reset to NULL" % state,
+                          None)
+        elif state == Gst.State.NULL:
+            # The bus is flushing in NULL, it does not tell about it
+            GLib.idle_add(self._emitCb, "state-change", state)
+
+    def _emitCb(self, signame, *args):
+        self.emit(signame, *args)
+        return False
 
     def _busMessageCb(self, unused_bus, message):
         if message.type == Gst.MessageType.EOS:
@@ -433,3 +563,64 @@ class SimplePipeline(Signallable, Loggable):
 
         if not res:
             raise PipelineError("Couldn't get duration: Returned None")
+
+        return dur
+
+
+# GstPlayFlags of playbin, which are not introspectable
+PLAY_FLAG_VIS = 1 << 3
+
+
+class PlaybackEngine(SimplePipeline):
+    """
+    A playbin kept for the whole session.
+
+    Its sinks are created once, and stay open while L{load} only swaps the
+    media and whether its audio is shown through the visualization
+    instead of tearing down and building a new pipeline for each media.
+    """
+
+    def __init__(self, video_sink="xvimagesink", audio_sink="autoaudiosink",
+                 visualization="synaescope"):
+        playbin = Gst.ElementFactory.make("playbin", None)
+        if playbin is None:
+            raise PipelineError("playbin is not available")
+        video = Gst.ElementFactory.make(video_sink, "my_video_sink")
+        playbin.set_property("video-sink", video)
+        playbin.set_property("audio-sink", Gst.ElementFactory.make(audio_sink, None))
+        vis = Gst.ElementFactory.make(visualization, None)
+        if vis is not None:
+            if vis.find_property("shader") is not None:
+                vis.set_property("shader", 3)
+            playbin.set_property("vis-plugin", vis)
+        SimplePipeline.__init__(self, playbin, video)
+        self.uri = None
+
+    def load(self, uri, audio_only=False):
+        """
+        Switches to the media at uri, the pipeline is left in the READY
+        state, L{play} or L{pause} it afterwards.
+
+        The previous media is shut down by the state change worker, the
+        state changes and seeks asked for until it is done are queued
+        behind it.
+
+        @param audio_only: Whether to show the visualization, playbin only
+        uses it for media without video anyway.
+        """
+        self.uri = uri
+        # Makes the duration of the new media get emitted
+        self._duration = Gst.CLOCK_TIME_NONE
+        self._runAsync(self._load, uri, audio_only)
+
+    def _load(self, uri, audio_only):
+        # In the state change worker. READY rather than NULL, so that the
+        # sinks keep their resources
+        self._changeState(Gst.State.READY)
+        flags = self._pipeline.get_property("flags")
+        if audio_only:
+            flags |= PLAY_FLAG_VIS
+        else:
+            flags &= ~PLAY_FLAG_VIS
+        self._pipeline.set_property("flags", flags)
+        self._pipeline.set_property("uri", uri)
@@ -0,0 +1,189 @@
+"""
+Speculative download of the beginning of search results.
+
+The first bytes of the top results are fetched in the background, so that
+clicking one of them can start playback right away while the download
+resumes from where the prefetch stopped.
+"""
+import os
+import Queue
+import thread
+import threading
+
+from collections import OrderedDict
+
+import bandwidth
+from FileDownloader import FileDownloader
+from loggable import Loggable
+from media_cache import get_default_cache
+from service_interface import PREVIEW
+from config import MINIMUM_DOWNLOADED_SIZE, PREFETCH_ENTRIES, PREFETCH_RATE_LIMIT, PREFETCH_DISK_BUDGET, \
+    DOWNLOAD_TIMEOUT
+
+
+class PrefetchJob(object):
+    def __init__(self, entry):
+        self.entry = entry
+        self.downloader = None
+        self.started = False
+        self.cancelled = False
+        self.done = threading.Event()
+
+
+class Prefetcher(Loggable):
+    """
+    Prefetches the first MINIMUM_DOWNLOADED_SIZE bytes of search results,
+    one at a time, under a bandwidth and a disk budget.
+    """
+
+    def __init__(self, entries=PREFETCH_ENTRIES, max_bytes=MINIMUM_DOWNLOADED_SIZE,
+                 rate_limit=PREFETCH_RATE_LIMIT, disk_budget=PREFETCH_DISK_BUDGET):
+        Loggable.__init__(self)
+        self.entries = entries
+        self.max_bytes = max_bytes
+        self.rate_limit = rate_limit
+        self.disk_budget = disk_budget
+        self._lock = thread.allocate_lock()
+        self._queue = Queue.Queue()
+        # url -> PrefetchJob, for jobs that did not finish yet
+        self._jobs = {}
+        # url -> prefetched file not played yet, oldest first
+        self._files = OrderedDict()
+
+        if self.entries:
+            worker = threading.Thread(target=self._run)
+            worker.daemon = True
+            worker.start()
+
+    def prefetch(self, entries):
+        """
+        Prefetches the first entries, jobs of a previous search that did not
+        start yet are dropped.
+        """
+        if not self.entries:
+            return
+
+        self._lock.acquire()
+        try:
+            for job in self._jobs.itervalues():
+                if not job.started:
+                    job.cancelled = True
+
+            for entry in entries[:self.entries]:
+                url = entry.media_url
+                if url in self._files or (url in self._jobs and not self._jobs[url].cancelled):
+                    continue
+                if get_default_cache().lookup(url, purpose=PREVIEW) is not None:
+                    continue
+                job = PrefetchJob(entry)
+                self._jobs[url] = job
+                self._queue.put(job)
+        finally:
+            self._lock.release()
+
+    def claim(self, url):
+        """
+        Stops prefetching url and forgets about its file, which now belongs
+        to the caller. Returns once nothing writes to that file anymore.
+        """
+        self._lock.acquire()
+        try:
+            self._files.pop(url, None)
+            job = self._jobs.get(url)
+            if job is None:
+                return
+            job.cancelled = True
+            if not job.started:
+                job.done.set()
+            elif job.downloader is not None:
+                job.downloader.stop_download()
+        finally:
+            self._lock.release()
+
+        job.done.wait()
+
+    def cleanup(self):
+        """
+        Removes the prefetched files that were never played.
+        """
+        self._lock.acquire()
+        try:
+            for job in self._jobs.itervalues():
+                job.cancelled = True
+                if job.downloader is not None:
+                    job.downloader.stop_download()
+            while self._files:
+                self._removeOldest()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        bandwidth.set_thread_class(bandwidth.BACKGROUND)
+        while True:
+            job = self._queue.get()
+            url = job.entry.media_url
+            self._lock.acquire()
+            if job.cancelled:
+                if self._jobs.get(url) is job:
+                    del self._jobs[url]
+                job.done.set()
+                self._lock.release()
+                continue
+            job.started = True
+            self._lock.release()
+
+            try:
+                self._prefetchJob(job)
+            except Exception, e:
+                self.warning("Could not prefetch %s: %s", url, e)
+            finally:
+                self._lock.acquire()
+                if self._jobs.get(url) is job:
+                    del self._jobs[url]
+                job.done.set()
+                self._lock.release()
+
+    def _prefetchJob(self, job):
+        self._lock.acquire()
+        try:
+            while self._files and self._getFilesSize() + self.max_bytes > self.disk_budget:
+                self._removeOldest()
+        finally:
+            self._lock.release()
+
+        service = job.entry.service
+        real_url, target = service.resolveUrl(job.entry.media_url)
+        downloader = FileDownloader(service, {"quiet": True, "ratelimit": self.rate_limit,
+                                              "bandwidth_class": bandwidth.BACKGROUND,
+                                              "socket_timeout": DOWNLOAD_TIMEOUT})
+
+        self._lock.acquire()
+        try:
+            if job.cancelled:
+                return
+            job.downloader = downloader
+        finally:
+            self._lock.release()
+
+        if downloader.prefetch(unicode(target), real_url, self.max_bytes):
+            self._lock.acquire()
+            if not job.cancelled:
+                self.debug("Prefetched %s", job.entry.media_url)
+                self._files[job.entry.media_url] = downloader.temp_name(target)
+            self._lock.release()
+
+    def _getFilesSize(self):
+        size = 0
+        for path in self._files.itervalues():
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def _removeOldest(self):
+        unused_url, path = self._files.popitem(last=False)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,260 @@
+"""
+Bookkeeping of the byte ranges of a media downloaded over several
+connections.
+
+The file is allocated at its full size and filled in any order, a
+L{RangeMap} tells which parts of it are complete and L{RangeScheduler}
+hands out the parts left to the connections, starting where the player
+needs them.
+"""
+import bisect
+import json
+import os
+import thread
+
+
+class RangeMap(object):
+    """
+    Sorted, disjoint and merged [start, end) ranges of bytes.
+    """
+
+    def __init__(self, ranges=()):
+        self._starts = []
+        self._ends = []
+        for start, end in ranges:
+            self.add(start, end)
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        # Ranges touching [start, end) are merged with it
+        first = bisect.bisect_left(self._ends, start)
+        last = bisect.bisect_right(self._starts, end)
+        if first < last:
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+
+    def getAvailable(self, offset):
+        """
+        Returns the number of complete bytes from offset on.
+        """
+        index = bisect.bisect_right(self._starts, offset) - 1
+        if index < 0 or self._ends[index] <= offset:
+            return 0
+        return self._ends[index] - offset
+
+    def nextMissing(self, offset, length):
+        """
+        Returns the first [start, end) range missing between offset and
+        length, or None if they are all complete.
+        """
+        offset += self.getAvailable(offset)
+        if offset >= length:
+            return None
+        index = bisect.bisect_right(self._starts, offset)
+        if index < len(self._starts):
+            return offset, min(self._starts[index], length)
+        return offset, length
+
+    def getTotal(self):
+        return sum(end - start for start, end in zip(self._starts, self._ends))
+
+    def getRanges(self):
+        return zip(self._starts, self._ends)
+
+
+class RangeClaim(object):
+    """
+    The bytes from pos to end included that one connection fetches, end
+    can be lowered by the scheduler while it runs.
+    """
+
+    def __init__(self, pos, end):
+        self.pos = pos
+        self.end = end
+
+    def getRemaining(self):
+        return max(0, self.end + 1 - self.pos)
+
+
+class RangeScheduler(object):
+    """
+    Splits the missing bytes of a file of length bytes among connections.
+
+    Claims are never split in parts smaller than min_split bytes. All the
+    methods can be called from any thread.
+    """
+
+    def __init__(self, length, min_split, completed=None):
+        self.length = length
+        self.min_split = min_split
+        self._completed = completed or RangeMap()
+        self._claims = []
+        self._lock = thread.allocate_lock()
+
+    def claimRange(self, start, end):
+        """
+        Claims the bytes of [start, end] that are missing, returns None if
+        there are none.
+        """
+        self._lock.acquire()
+        try:
+            missing = self._completed.nextMissing(start, end + 1)
+            if missing is None:
+                return None
+            claim = RangeClaim(missing[0], missing[1] - 1)
+            self._claims.append(claim)
+            return claim
+        finally:
+            self._lock.release()
+
+    def claimNext(self, max_claims):
+        """
+        Returns what a connection that finished its claim should fetch
+        next, or None if it should stop as max_claims are already running
+        or there is nothing left worth splitting.
+        """
+        self._lock.acquire()
+        try:
+            if len(self._claims) >= max_claims:
+                return None
+            # Holes left by connections that gave up come first
+            offset = 0
+            while True:
+                missing = self._completed.nextMissing(offset, self.length)
+                if missing is None:
+                    break
+                unclaimed = self._findUnclaimed(*missing)
+                if unclaimed is not None:
+                    claim = RangeClaim(unclaimed[0], unclaimed[1] - 1)
+                    self._claims.append(claim)
+                    return claim
+                offset = missing[1]
+
+            # Take the second half of the largest claim
+            if not self._claims:
+                return None
+            largest = max(self._claims, key=RangeClaim.getRemaining)
+            if largest.getRemaining() < 2 * self.min_split:
+                return None
+            return self._split(largest, largest.pos + largest.getRemaining() // 2)
+        finally:
+            self._lock.release()
+
+    def prioritize(self, offset):
+        """
+        Makes the first missing bytes from offset on get fetched next.
+
+        Returns the claim a new connection has to fetch, or None if these
+        bytes are complete or about to be fetched by a running connection.
+        """
+        self._lock.acquire()
+        try:
+            missing = self._completed.nextMissing(offset, self.length)
+            if missing is None:
+                return None
+            start, end = missing
+            for claim in self._claims:
+                if claim.pos <= start <= claim.end:
+                    if start - claim.pos < self.min_split:
+                        # That connection gets there soon enough
+                        return None
+                    return self._split(claim, start)
+            # Stop before the next claim, the bytes after are being fetched
+            start, end = self._findUnclaimed(start, end)
+            claim = RangeClaim(start, end - 1)
+            self._claims.append(claim)
+            return claim
+        finally:
+            self._lock.release()
+
+    def complete(self, claim, count):
+        """
+        Records that count bytes were written at claim.pos, returns False
+        once the claim is done.
+        """
+        self._lock.acquire()
+        try:
+            self._completed.add(claim.pos, claim.pos + count)
+            claim.pos += count
+            return claim.pos <= claim.end
+        finally:
+            self._lock.release()
+
+    def release(self, claim):
+        self._lock.acquire()
+        try:
+            if claim in self._claims:
+                self._claims.remove(claim)
+        finally:
+            self._lock.release()
+
+    def getAvailable(self, offset):
+        self._lock.acquire()
+        try:
+            return self._completed.getAvailable(offset)
+        finally:
+            self._lock.release()
+
+    def getCompleted(self):
+        self._lock.acquire()
+        try:
+            return self._completed.getTotal()
+        finally:
+            self._lock.release()
+
+    def isComplete(self):
+        return self.getAvailable(0) >= self.length
+
+    def save(self, path):
+        """
+        Writes the complete ranges to path, to resume the download later.
+        """
+        self._lock.acquire()
+        try:
+            state = {"length": self.length, "ranges": self._completed.getRanges()}
+        finally:
+            self._lock.release()
+        # Write then rename, so that a crash never leaves a truncated state
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.rename(tmp_path, path)
+
+    def _findUnclaimed(self, start, end):
+        cursor = start
+        for claim in sorted(self._claims, key=lambda claim: claim.pos):
+            if claim.end < cursor or claim.pos >= end:
+                continue
+            if claim.pos > cursor:
+                break
+            cursor = claim.end + 1
+        if cursor >= end:
+            return None
+        for claim in self._claims:
+            if cursor < claim.pos < end:
+                end = claim.pos
+        return cursor, end
+
+    def _split(self, claim, offset):
+        stolen = RangeClaim(offset, claim.end)
+        claim.end = offset - 1
+        self._claims.append(stolen)
+        return stolen
+
+
+def load_ranges(path, length):
+    """
+    Returns the L{RangeMap} saved at path for a file of length bytes, or
+    None if there is none or it was saved for another length.
+    """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if state.get("length") != length:
+        return None
+    return RangeMap(state.get("ranges", []))
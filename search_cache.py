@@ -0,0 +1,117 @@
+"""
+Cache of search results, shared by all the services.
+
+Results are kept as lists of serialized L{MediaEntry}, for SEARCH_CACHE_TTL
+seconds, in a bounded LRU that can be persisted to disk. Concurrent
+identical searches wait for the first one instead of querying the backend
+again.
+"""
+import json
+import os
+import thread
+import time
+
+from collections import OrderedDict
+
+import singleflight
+from config import SEARCH_CACHE_TTL, SEARCH_CACHE_ENTRIES, SEARCH_CACHE_FILE
+
+
+def normalize_query(words):
+    # Gtk entries give UTF-8 encoded str
+    if isinstance(words, str):
+        words = words.decode("utf-8", "replace")
+    return u" ".join(words.lower().split())
+
+
+class SearchCache(object):
+    def __init__(self, ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_ENTRIES,
+                 path=SEARCH_CACHE_FILE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self._lock = thread.allocate_lock()
+        # key -> (timestamp, results), least recently used first
+        self._entries = OrderedDict()
+        self._flights = singleflight.Group()
+        self._load()
+
+    def get(self, service_name, words, page, search):
+        """
+        Returns the cached results for the query, calling search() to get
+        them if needed. search must return a list of serialized entries.
+        """
+        key = u"%s\0%s\0%d" % (service_name, normalize_query(words), page)
+        results = self._lookup(key)
+        if results is not None:
+            return results
+        return self._flights.do(key, lambda: self._search(key, search))
+
+    def _lookup(self, key):
+        self._lock.acquire()
+        try:
+            cached = self._entries.pop(key, None)
+            if cached is not None and time.time() - cached[0] < self.ttl:
+                self._entries[key] = cached
+                return cached[1]
+            return None
+        finally:
+            self._lock.release()
+
+    def _search(self, key, search):
+        # Stored by a search that ended since the lookup
+        results = self._lookup(key)
+        if results is None:
+            results = search()
+            self._store(key, results)
+        return results
+
+    def clear(self):
+        self._lock.acquire()
+        self._entries.clear()
+        self._lock.release()
+        self._save()
+
+    def _store(self, key, results):
+        self._lock.acquire()
+        try:
+            self._entries[key] = (time.time(), results)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+        self._save()
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return
+        now = time.time()
+        for key, timestamp, results in entries:
+            if now - timestamp < self.ttl:
+                self._entries[key] = (timestamp, results)
+
+    def _save(self):
+        if not self.path:
+            return
+        self._lock.acquire()
+        try:
+            entries = [(key, timestamp, results)
+                       for key, (timestamp, results) in self._entries.iteritems()]
+        finally:
+            self._lock.release()
+
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + ".tmp.%d" % thread.get_ident()
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.rename(tmp_path, self.path)
+
+
+get_default_cache = singleflight.once(SearchCache)
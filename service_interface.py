@@ -1,34 +1,249 @@
 import os
+import thread
 import youtube_dl
+import bandwidth
+import http_pool
+import info_cache
+import search_cache
 from FileDownloader import FileDownloader
+from media_entry import MediaEntry
+from media_cache import get_default_cache
+from config import DOWNLOAD_SEGMENTS, DOWNLOAD_TIMEOUT
+
+# What a media is downloaded for, see L{ServiceInterface.selectFormat}
+PREVIEW = "preview"
+CONVERT = "convert"
+KEEP = "keep"
+
+
+def _get_bitrate(format):
+    """
+    Returns the total bitrate of format, None if it is not known.
+    """
+    if format.get("tbr"):
+        return format["tbr"]
+    audio = format.get("abr")
+    video = format.get("vbr")
+    if format.get("vcodec") == "none":
+        return audio or None
+    if format.get("acodec") == "none":
+        return video or None
+    if audio and video:
+        return audio + video
+    return None
+
 
 class ServiceInterface:
     def __init__(self):
-        self.downloader = None
+        # (purpose, FileDownloader) of the running downloads
+        self._downloaders = []
+        # Path -> FileDownloader writing to it, a same format can be
+        # downloaded for several purposes at once
+        self._targets = {}
+        self._targets_lock = thread.allocate_lock()
         self._ydl = youtube_dl.YoutubeDL({'outtmpl': '%(id)s%(ext)s'})
         self._ydl.add_default_info_extractors()
+        http_pool.install(self._ydl)
         self._name = None
 
-    def search (self, words):
+    def search(self, words, page=0):
+        """
+        Returns a list of L{MediaEntry} matching words, going through the
+        search cache.
+        """
+        results = search_cache.get_default_cache().get(
+            self._name, words, page,
+            lambda: [entry.serialize() for entry in self._doSearch(words, page)])
+        return [MediaEntry.deserialize(data, self) for data in results]
+
+    def _doSearch(self, words, page):
         raise NotImplementedError
 
     def authenticate(self):
         raise NotImplementedError
 
-    def downloadUrl(self, url, progress_hook):
-        infos = self._ydl.extract_info(url, download=False)
+    def createDownloader(self, progress_hook=None, purpose=PREVIEW):
+        """
+        Returns a FileDownloader for L{downloadUrl}. Creating it before
+        starting the download thread lets stop_download cancel the download
+        at any point.
+
+        Only one media is played at a time, the previous PREVIEW download is
+        stopped. Downloads for the other purposes run side by side.
+        """
+        # Only what is being played must not wait for other transfers
+        if purpose == PREVIEW:
+            klass = bandwidth.PLAYBACK
+        else:
+            klass = bandwidth.BACKGROUND
+
         params = {}
         params["quiet"] = True
+        params["segments"] = DOWNLOAD_SEGMENTS
+        # Resume what a prefetch or an interrupted download left behind
+        params["continuedl"] = True
+        params["bandwidth_class"] = klass
+        params["socket_timeout"] = DOWNLOAD_TIMEOUT
         downloader = FileDownloader(self, params)
-        downloader.add_progress_hook(progress_hook)
-        self.downloader = downloader
-        target = os.path.join(os.getcwd(), "data", url.split("/")[-1])
-        real_url = self._get_url_from_infos(infos)
+        if progress_hook is not None:
+            downloader.add_progress_hook(progress_hook)
+        if purpose == PREVIEW:
+            self.stop_download(PREVIEW)
+        self._downloaders.append((purpose, downloader))
+        return downloader
+
+    def downloadUrl(self, url, progress_hook, purpose=PREVIEW, downloader=None):
+        """
+        Downloads the media of the page at url in the format for purpose,
+        or finds it in the media cache. Returns True once it is complete.
+        """
+        if downloader is None:
+            downloader = self.createDownloader(progress_hook, purpose)
+        try:
+            return self._download(url, progress_hook, purpose, downloader)
+        finally:
+            try:
+                self._downloaders.remove((purpose, downloader))
+            except ValueError:
+                pass
+
+    def _download(self, url, progress_hook, purpose, downloader):
+        bandwidth.set_thread_class(downloader.params["bandwidth_class"])
+
+        cache = get_default_cache()
+        cached = cache.lookup(url, purpose=purpose)
+        if downloader.is_stopped():
+            return False
+        if cached is not None:
+            size = os.path.getsize(cached)
+            progress_hook({"filename": cached,
+                           "status": "finished",
+                           "downloaded_bytes": size,
+                           "total_bytes": size})
+            return True
+
+        real_url, target = self.resolveUrl(url, purpose)
+        while True:
+            if downloader.is_stopped():
+                return False
+            self._targets_lock.acquire()
+            running = self._targets.get(target)
+            if running is None:
+                self._targets[target] = downloader
+            self._targets_lock.release()
+            if running is None:
+                break
+            if self._joinDownload(running, downloader, target, progress_hook):
+                return True
+            # It was stopped, take over from where it was
+
         print "real url is : ", real_url
-        downloader._do_download(unicode(target), real_url)
+        try:
+            if downloader._do_download(unicode(target), real_url):
+                cache.add(url, real_url.get("format_id"), target, purpose)
+                return True
+        finally:
+            self._targets_lock.acquire()
+            del self._targets[target]
+            self._targets_lock.release()
+        if not downloader.is_stopped():
+            # The signed URL may have been refused, extract it again next time
+            info_cache.get_default_cache().invalidate(url)
+        return False
 
-    def stop_download(self):
-        self.downloader.stop_download()
+    def _joinDownload(self, running, downloader, target, progress_hook):
+        """
+        Follows the progress of running, which downloads to target for
+        another purpose, rather than writing to the same file. Returns True
+        once target is complete, False if running or downloader got stopped.
+        """
+        finished = []
+
+        def hook(status):
+            if status["status"] == "finished":
+                finished.append(status)
+            progress_hook(status)
+        running.add_progress_hook(hook)
+
+        while not running.join(0.5):
+            if downloader.is_stopped():
+                return False
+        if not os.path.isfile(target):
+            return False
+        if not finished:
+            # It completed before the hook was added
+            size = os.path.getsize(target)
+            progress_hook({"filename": target,
+                           "status": "finished",
+                           "downloaded_bytes": size,
+                           "total_bytes": size})
+        return True
+
+    def resolveUrl(self, url, purpose=PREVIEW):
+        """
+        Returns the format to download for the page at url, and the
+        path of that format in the media cache.
+        """
+        infos = info_cache.get_default_cache().get(url, lambda: self._extractInfo(url))
+        real_url = self.selectFormat(infos, purpose)
+        target = get_default_cache().pathFor(url, real_url.get("format_id"), real_url.get("ext"))
+        return real_url, target
+
+    def sharesFormat(self, url, purpose, other=PREVIEW):
+        """
+        Returns True if url is downloaded in the same format for purpose
+        and for other, so that a download for one can serve the other.
+        """
+        infos = info_cache.get_default_cache().get(url, lambda: self._extractInfo(url))
+        return self.selectFormat(infos, purpose).get("format_id") == \
+            self.selectFormat(infos, other).get("format_id")
+
+    def resolveAhead(self, url, priority=0):
+        """
+        Extracts the infos of the page at url in the background, so that
+        downloading it later does not have to.
+        """
+        info_cache.get_default_cache().resolveAhead(url, lambda: self._extractInfo(url), priority)
+
+    def _extractInfo(self, url):
+        return self._ydl.extract_info(url, download=False)
+
+    def selectFormat(self, infos, purpose=PREVIEW):
+        """
+        Picks one of the formats extract_info returned:
+         - PREVIEW : the lowest bitrate that can be played, with video if
+           the media has any.
+         - CONVERT : the best audio only format, as the video would be
+           thrown away.
+         - KEEP : the best quality.
+        Formats whose bitrate is unknown are ranked after the others, in the
+        order youtube_dl lists them, worst first.
+        """
+        formats = self._get_formats_from_infos(infos)
+        with_audio = [format for format in formats if format.get("acodec") != "none"] or formats
+
+        def rank(format):
+            bitrate = _get_bitrate(format)
+            return (bitrate is None, bitrate, formats.index(format))
+        ranked = sorted(with_audio, key=rank)
+
+        if purpose == CONVERT:
+            audio_only = [format for format in ranked if format.get("vcodec") == "none"]
+            return (audio_only or ranked)[-1]
+        if purpose == KEEP:
+            # Stable, so the best bitrate wins among formats of the same height
+            return sorted(ranked, key=lambda format: format.get("height") or 0)[-1]
+        with_video = [format for format in ranked if format.get("vcodec") != "none"]
+        return (with_video or ranked)[0]
+
+    def stop_download(self, purpose=PREVIEW):
+        """
+        Stops the running downloads for purpose, all of them if purpose is
+        None.
+        """
+        for downloader_purpose, downloader in list(self._downloaders):
+            if purpose in (None, downloader_purpose):
+                downloader.stop_download()
 
     def to_screen(self, *args, **kargs):
         pass
@@ -51,5 +266,7 @@ class ServiceInterface:
     def getName(self):
         return self._name
 
-    def _get_url_from_infos(self, infos):
-        raise NotImplementedError
+    def _get_formats_from_infos(self, infos):
+        if "entries" in infos:
+            infos = infos["entries"][0]
+        return infos.get("formats") or [infos]
@@ -0,0 +1,72 @@
+"""
+Sharing of work between threads.
+
+L{Group} runs a function once for all the concurrent calls made with a
+same key, L{once} creates the objects the whole application shares.
+"""
+import thread
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group(object):
+    """
+    Calls made with a same key while the first one runs wait for it and
+    get its result, or its exception, instead of doing the work again.
+    """
+
+    def __init__(self):
+        self._lock = thread.allocate_lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        self._lock.acquire()
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            self._calls[key] = call
+        self._lock.release()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            self._lock.acquire()
+            del self._calls[key]
+            self._lock.release()
+            call.done.set()
+        return call.result
+
+
+def once(factory):
+    """
+    Returns a function that calls factory the first time it is called,
+    from any thread, and returns that same result from then on.
+    """
+    lock = thread.allocate_lock()
+    instances = []
+
+    def get():
+        lock.acquire()
+        try:
+            if not instances:
+                instances.append(factory())
+            return instances[0]
+        finally:
+            lock.release()
+    return get
@@ -2,6 +2,7 @@ import soundcloud
 
 from media_entry import MediaEntry
 from service_interface import ServiceInterface
+from config import RESULTS_PER_PAGE
 
 import youtube_dl
 from FileDownloader import FileDownloader
@@ -10,17 +11,18 @@ class SoundCloudService(ServiceInterface):
     def __init__(self):
         ServiceInterface.__init__(self)
         self._client = soundcloud.Client(client_id="a0f302b73e746e103ea4be14fac09677")
-        self.downloader = None
-        self._current_feed = None
         self._name = "soundcloud"
 
-    def search(self, words):
-        self._current_feed = self._client.get('/tracks', q=words)
-        return self._createMediaEntries()
+    def _doSearch(self, words, page):
+        # Several searches can run at the same time, the feed is not shared
+        feed = self._client.get('/tracks', q=words,
+                                limit=RESULTS_PER_PAGE,
+                                offset=page * RESULTS_PER_PAGE)
+        return self._createMediaEntries(feed)
 
-    def _createMediaEntries(self):
+    def _createMediaEntries(self, feed):
         _entries = []
-        for entry in self._current_feed:
+        for entry in feed:
             artwork_url = entry.obj["artwork_url"]
             if artwork_url is None:
                 artwork_url = "soundcloud_default.png"
@@ -33,6 +35,3 @@ class SoundCloudService(ServiceInterface):
                                      audio_only=True)
             _entries.append(_mediaEntry)
         return _entries
-
-    def _get_url_from_infos(self, infos):
-        return infos["formats"][0]
@@ -0,0 +1,125 @@
+"""
+Supervision of the external programs some downloads rely on, such as
+rtmpdump, mplayer and ffmpeg.
+
+Their stderr is read by a background thread in large chunks and split in
+lines, so that the download thread only has to poll, and they can be
+stopped at any time.
+"""
+import os
+import Queue
+import re
+import subprocess
+import thread
+import threading
+
+from distutils.spawn import find_executable
+
+LINE_SEPARATOR_RE = re.compile(r'[\r\n]')
+# Seconds given to a stopped program to exit before it gets killed
+STOP_GRACE_PERIOD = 2
+
+_programs = {}
+_programs_lock = thread.allocate_lock()
+
+
+def find_program(*names):
+    """
+    Returns the path of the first of names that can be found in PATH, or
+    None. Lookups are only made once per process.
+    """
+    _programs_lock.acquire()
+    try:
+        if names not in _programs:
+            for name in names:
+                path = find_executable(name)
+                if path is not None:
+                    break
+            _programs[names] = path
+        return _programs[names]
+    finally:
+        _programs_lock.release()
+
+
+class SupervisedProcess(object):
+    """
+    @ivar returncode: The exit code of the program, None while it runs
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.returncode = None
+        self._proc = None
+        self._lines = Queue.Queue()
+        self._exited = threading.Event()
+        self._stopped = False
+
+    def start(self):
+        self._proc = subprocess.Popen(self.args, stdout=open(os.devnull, 'w'),
+                                      stderr=subprocess.PIPE, close_fds=True)
+        reader = threading.Thread(target=self._readStderr)
+        reader.daemon = True
+        reader.start()
+
+    def wait(self, timeout=None):
+        """
+        Returns True once the program exited, False if it still runs after
+        timeout seconds.
+        """
+        self._exited.wait(timeout)
+        return self._exited.is_set()
+
+    def readLines(self):
+        """
+        Returns the lines written to stderr since the last call.
+        """
+        lines = []
+        while True:
+            try:
+                lines.append(self._lines.get_nowait())
+            except Queue.Empty:
+                return lines
+
+    def stop(self):
+        """
+        Asks the program to exit, and kills it if it did not after
+        STOP_GRACE_PERIOD seconds. Does not block.
+        """
+        self._stopped = True
+        if self._proc is None or self._exited.is_set():
+            return
+        try:
+            self._proc.terminate()
+        except OSError:
+            return
+        killer = threading.Timer(STOP_GRACE_PERIOD, self._kill)
+        killer.daemon = True
+        killer.start()
+
+    def isStopped(self):
+        return self._stopped
+
+    def _kill(self):
+        if not self._exited.is_set():
+            try:
+                self._proc.kill()
+            except OSError:
+                pass
+
+    def _readStderr(self):
+        fd = self._proc.stderr.fileno()
+        pending = b''
+        while True:
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                break
+            parts = LINE_SEPARATOR_RE.split(pending + chunk)
+            pending = parts.pop()
+            for part in parts:
+                if part:
+                    self._lines.put(part.decode('ascii', 'replace'))
+        if pending:
+            self._lines.put(pending.decode('ascii', 'replace'))
+        self._proc.stderr.close()
+        self.returncode = self._proc.wait()
+        self._exited.set()
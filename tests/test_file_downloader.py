@@ -0,0 +1,66 @@
+import threading
+import time
+import unittest
+
+from FileDownloader import FileDownloader
+
+
+def downloading(count):
+    return {"status": "downloading", "downloaded_bytes": count, "total_bytes": 100}
+
+
+class TestProgressHooks(unittest.TestCase):
+    def setUp(self):
+        self.downloader = FileDownloader(None, {"quiet": True, "progress_interval": 0})
+        self.statuses = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+        def hook(status):
+            self.entered.set()
+            self.release.wait()
+            self.statuses.append(status)
+        self.downloader.add_progress_hook(hook)
+
+    def tearDown(self):
+        # Lets a blocked hook return even if the test failed
+        self.release.set()
+
+    def testNoHookAfterStop(self):
+        self.release.set()
+        self.downloader._hook_progress(downloading(10))
+        self.downloader.stop_download()
+        self.downloader._hook_progress(downloading(20))
+        self.downloader._hook_progress({"status": "finished", "filename": "f"})
+        self.assertEqual([status["downloaded_bytes"] for status in self.statuses], [10])
+
+    def testStopWaitsForRunningHook(self):
+        delivery = threading.Thread(target=self.downloader._hook_progress, args=(downloading(10),))
+        delivery.start()
+        self.entered.wait()
+
+        stopped = threading.Event()
+
+        def stop():
+            self.downloader.stop_download()
+            stopped.set()
+        stopper = threading.Thread(target=stop)
+        stopper.start()
+        time.sleep(0.1)
+        # The hook is still running, stop_download must not have returned
+        self.assertFalse(stopped.is_set())
+
+        self.release.set()
+        stopper.join()
+        delivery.join()
+        self.assertEqual(len(self.statuses), 1)
+
+    def testHookCanStopTheDownload(self):
+        self.release.set()
+        self.downloader.add_progress_hook(lambda status: self.downloader.stop_download())
+        self.downloader._hook_progress(downloading(10))
+        self.assertTrue(self.downloader.is_stopped())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from media_cache import MediaCache
+
+
+def write(path, size, age=0):
+    with open(path, "wb") as f:
+        f.write("x" * size)
+    if age:
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+
+class TestMediaCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _add(self, cache, url, size):
+        path = cache.pathFor(url, "18", "mp4")
+        write(path, size)
+        cache.add(url, "18", path)
+        return path
+
+    def testAbandonedPartialIsEvicted(self):
+        cache = MediaCache(self.directory, max_size=1000, partial_grace=60)
+        part = cache.pathFor("http://a", "18", "mp4") + ".part"
+        write(part, 800, age=3600)
+        write(part + ".ranges", 10, age=3600)
+        self.assertEqual(cache.getSize(), 810)
+
+        # The abandoned download pushes the cache over its cap
+        path = self._add(cache, "http://b", 500)
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(part))
+        self.assertFalse(os.path.exists(part + ".ranges"))
+        self.assertEqual(cache.getSize(), 500)
+
+    def testRunningDownloadIsKept(self):
+        cache = MediaCache(self.directory, max_size=1000, partial_grace=60)
+        part = cache.pathFor("http://a", "18", "mp4") + ".part"
+        write(part, 800)
+        old = self._add(cache, "http://b", 300)
+        self._add(cache, "http://c", 300)
+        # The least recently used media goes instead
+        self.assertTrue(os.path.exists(part))
+        self.assertFalse(os.path.exists(old))
+
+    def testPartialsAreSweptAtStartup(self):
+        part = os.path.join(self.directory, "0123.mp4.part")
+        write(part, 2000, age=3600)
+        MediaCache(self.directory, max_size=1000, partial_grace=60)
+        self.assertFalse(os.path.exists(part))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import threading
+import time
+import unittest
+
+import singleflight
+
+
+class TestGroup(unittest.TestCase):
+    def testConcurrentCallsShareTheResult(self):
+        group = singleflight.Group()
+        calls = []
+        results = []
+
+        def work():
+            calls.append(1)
+            time.sleep(0.2)
+            return "result"
+
+        threads = [threading.Thread(target=lambda: results.append(group.do("key", work)))
+                   for unused_i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["result"] * 5)
+
+    def testErrorIsRaisedAndNotKept(self):
+        group = singleflight.Group()
+
+        def fail():
+            raise ValueError("failed")
+        self.assertRaises(ValueError, group.do, "key", fail)
+        self.assertEqual(group.do("key", lambda: 1), 1)
+
+
+class TestOnce(unittest.TestCase):
+    def testFactoryIsCalledOnce(self):
+        get = singleflight.once(object)
+        self.assertTrue(get() is get())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+"""
+Persistent cache of thumbnails.
+
+For every thumbnail URL the original bytes are kept, along with a scaled
+copy per cell size. Thumbnails are served from disk while fresh, then
+revalidated with If-None-Match / If-Modified-Since.
+"""
+import hashlib
+import json
+import os
+import re
+import thread
+import time
+
+import http_pool
+from youtube_dl.utils import compat_urllib_error, compat_urllib_request
+from config import THUMBNAIL_CACHE_DIRECTORY, THUMBNAIL_CACHE_SIZE, THUMBNAIL_CACHE_TTL, DOWNLOAD_TIMEOUT
+
+INDEX_NAME = "index.json"
+# Do not rewrite the index more often than this number of seconds
+INDEX_SAVE_INTERVAL = 5
+
+
+class ThumbnailCache(object):
+    def __init__(self, directory=THUMBNAIL_CACHE_DIRECTORY, max_size=THUMBNAIL_CACHE_SIZE,
+                 ttl=THUMBNAIL_CACHE_TTL):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = thread.allocate_lock()
+        self._index_path = os.path.join(directory, INDEX_NAME)
+        self._last_save = 0
+        self._dirty = False
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        try:
+            with open(self._index_path) as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            self._entries = {}
+
+    def lookupScaled(self, url, width, height):
+        """
+        Returns the path of the scaled copy of a fresh thumbnail, or None.
+        """
+        self._lock.acquire()
+        try:
+            key = self._makeKey(url)
+            entry = self._entries.get(key)
+            if entry is None or entry["expires"] < time.time():
+                return None
+            path = self._scaledPath(key, width, height)
+            if not os.path.isfile(path):
+                return None
+            entry["last_used"] = time.time()
+            self._dirty = True
+            return path
+        finally:
+            self._lock.release()
+
+    def fetch(self, url):
+        """
+        Returns a (data, modified) tuple, data being the original bytes of
+        the thumbnail, and modified telling whether they changed since the
+        scaled copies were made.
+        """
+        key = self._makeKey(url)
+        self._lock.acquire()
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry = dict(entry)
+        self._lock.release()
+
+        original = os.path.join(self.directory, key)
+        if entry is not None and os.path.isfile(original):
+            if entry["expires"] >= time.time():
+                return self._read(original), False
+            request = compat_urllib_request.Request(url)
+            if entry.get("etag"):
+                request.add_header("If-None-Match", entry["etag"])
+            if entry.get("last_modified"):
+                request.add_header("If-Modified-Since", entry["last_modified"])
+        else:
+            entry = None
+            request = compat_urllib_request.Request(url)
+
+        try:
+            # A stalled host must not hold a thumbnail worker forever
+            response = http_pool.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+        except compat_urllib_error.HTTPError, e:
+            if e.code != 304 or entry is None:
+                raise
+            # Still valid, read the empty body so the connection can be reused
+            e.read()
+            e.close()
+            self._update(key, url, e.info(), None)
+            return self._read(original), False
+
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        self._update(key, url, response.info(), data)
+        return data, True
+
+    def storeScaled(self, url, width, height, pixbuf):
+        key = self._makeKey(url)
+        path = self._scaledPath(key, width, height)
+        tmp_path = path + ".tmp.%d" % thread.get_ident()
+        pixbuf.savev(tmp_path, "png", [], [])
+        os.rename(tmp_path, path)
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                scaled = entry.setdefault("scaled", [])
+                if os.path.basename(path) not in scaled:
+                    entry["size"] += os.path.getsize(path)
+                    scaled.append(os.path.basename(path))
+                self._evict(keep=key)
+            self._saveIndex()
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            if self._dirty:
+                self._saveIndex(force=True)
+        finally:
+            self._lock.release()
+
+    def _update(self, key, url, headers, data):
+        """
+        Records new validators for key, and its new original bytes if data
+        is not None.
+        """
+        now = time.time()
+        expires = now + self.ttl
+        match = re.search(r"max-age=(\d+)", headers.get("Cache-Control", ""))
+        if match:
+            expires = now + max(int(match.group(1)), self.ttl)
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if data is not None:
+                if entry is not None:
+                    self._removeFiles(entry, key)
+                original = os.path.join(self.directory, key)
+                tmp_path = original + ".tmp.%d" % thread.get_ident()
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.rename(tmp_path, original)
+                entry = {"url": url, "size": len(data), "scaled": []}
+                self._entries[key] = entry
+            if entry is None:
+                return
+            entry["etag"] = headers.get("ETag", entry.get("etag"))
+            entry["last_modified"] = headers.get("Last-Modified", entry.get("last_modified"))
+            entry["expires"] = expires
+            entry["last_used"] = now
+            self._evict(keep=key)
+            self._saveIndex()
+        finally:
+            self._lock.release()
+
+    def _evict(self, keep):
+        total = sum(entry["size"] for entry in self._entries.itervalues())
+        by_age = sorted(self._entries.items(), key=lambda item: item[1]["last_used"])
+        for key, entry in by_age:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self._removeFiles(entry, key)
+            total -= entry["size"]
+            del self._entries[key]
+
+    def _removeFiles(self, entry, key):
+        for name in [key] + entry.get("scaled", []):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _saveIndex(self, force=False):
+        self._dirty = True
+        now = time.time()
+        if not force and now - self._last_save < INDEX_SAVE_INTERVAL:
+            return
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._entries, f)
+        os.rename(tmp_path, self._index_path)
+        self._last_save = now
+        self._dirty = False
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _scaledPath(self, key, width, height):
+        return os.path.join(self.directory, "%s_%dx%d.png" % (key, width, height))
+
+    def _makeKey(self, url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
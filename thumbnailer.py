@@ -0,0 +1,108 @@
+"""
+Fixed size pool of workers fetching, decoding and scaling thumbnails.
+
+Requests are served by priority, lowest first, and only pixbufs ready to
+be displayed are handed to the main loop. Thumbnails and their scaled
+copies are kept in a L{ThumbnailCache}.
+"""
+import itertools
+import os
+import Queue
+import threading
+
+from gi.repository import GdkPixbuf
+from gi.repository import GLib
+
+import bandwidth
+from loggable import Loggable
+from thumbnail_cache import ThumbnailCache
+from config import THUMBNAIL_WORKERS, THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT
+
+
+class ThumbnailPool(Loggable):
+    def __init__(self, workers=THUMBNAIL_WORKERS, width=THUMBNAIL_WIDTH, height=THUMBNAIL_HEIGHT):
+        Loggable.__init__(self)
+        self.width = width
+        self.height = height
+        self._queue = Queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._generation = 0
+        self._cache = ThumbnailCache()
+
+        for unused_i in range(workers):
+            worker = threading.Thread(target=self._run)
+            worker.daemon = True
+            worker.start()
+
+    def fetch(self, url, priority, callback, *args):
+        """
+        Calls callback(pixbuf, *args) from the main loop once url has been
+        loaded and scaled, unless L{cancelPending} was called in between.
+        """
+        self._queue.put((priority, self._counter.next(), self._generation,
+                         url, callback, args))
+
+    def cancelPending(self):
+        """
+        Drops the requests that have not been delivered yet.
+        """
+        self._generation += 1
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Queue.Empty:
+                break
+
+    def cleanup(self):
+        self.cancelPending()
+        self._cache.flush()
+
+    def _run(self):
+        bandwidth.set_thread_class(bandwidth.THUMBNAILS)
+        while True:
+            unused_priority, unused_count, generation, url, callback, args = self._queue.get()
+            if generation != self._generation:
+                continue
+            try:
+                pixbuf = self._load(url)
+            except Exception, e:
+                self.warning("Could not load thumbnail %s: %s", url, e)
+                continue
+            if generation == self._generation:
+                GLib.idle_add(self._deliverCb, generation, pixbuf, callback, args)
+
+    def _deliverCb(self, generation, pixbuf, callback, args):
+        if generation == self._generation:
+            callback(pixbuf, *args)
+        return False
+
+    def _load(self, url):
+        if "://" not in url:
+            # Bundled image
+            return self._scale(GdkPixbuf.Pixbuf.new_from_file(os.path.join(os.getcwd(), url)))
+
+        path = self._cache.lookupScaled(url, self.width, self.height)
+        if path is not None:
+            return GdkPixbuf.Pixbuf.new_from_file(path)
+
+        data, modified = self._cache.fetch(url)
+        if not modified:
+            path = self._cache.lookupScaled(url, self.width, self.height)
+            if path is not None:
+                return GdkPixbuf.Pixbuf.new_from_file(path)
+
+        loader = GdkPixbuf.PixbufLoader()
+        loader.write(data)
+        loader.close()
+        pixbuf = self._scale(loader.get_pixbuf())
+        self._cache.storeScaled(url, self.width, self.height, pixbuf)
+        return pixbuf
+
+    def _scale(self, pixbuf):
+        width = pixbuf.get_width()
+        height = pixbuf.get_height()
+        if width <= self.width and height <= self.height:
+            return pixbuf
+        ratio = min(float(self.width) / width, float(self.height) / height)
+        return pixbuf.scale_simple(max(1, int(width * ratio)), max(1, int(height * ratio)),
+                                   GdkPixbuf.InterpType.BILINEAR)
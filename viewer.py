@@ -77,6 +77,10 @@ class PitiviViewer(Gtk.VBox, Loggable):
 
         self._haveUI = False
 
+        # Seeks go through the application, which knows what was downloaded
+        self.seeker = Seeker()
+        self.seeker.connect("seek", self._seekCb)
+
         self._createUi()
         self.target = self.internal
         self.undock_action = undock_action
@@ -258,6 +262,9 @@ class PitiviViewer(Gtk.VBox, Loggable):
         nanoseconds = self.timecode_entry.getWidgetValue()
         self.seeker.seek(nanoseconds)
 
+    def _seekCb(self, unused_seeker, position, format):
+        self.app.seek(position, format)
+
     ## active Timeline calllbacks
     def _durationChangedCb(self, unused_pipeline, duration):
         if duration == 0:
@@ -5,7 +5,7 @@ import os
 from media_entry import MediaEntry
 
 from service_interface import ServiceInterface
-from config import DEBUG
+from config import DEBUG, RESULTS_PER_PAGE
 
 class YouTubeService(ServiceInterface):
     def __init__(self):
@@ -17,25 +17,26 @@ class YouTubeService(ServiceInterface):
         self._yt_service = yt_service
         self._name = "youtube"
 
-        self._current_feed = None
-
-    def search(self, words):
+    def _doSearch(self, words, page):
         query = gdata.youtube.service.YouTubeVideoQuery()
         query.vq = words
+        query.start_index = page * RESULTS_PER_PAGE + 1
+        query.max_results = RESULTS_PER_PAGE
         query.orderby = 'viewCount'
         query.racy = 'include'
-        self._current_feed = self._yt_service.YouTubeQuery(query)
+        # Several searches can run at the same time, the feed is not shared
+        feed = self._yt_service.YouTubeQuery(query)
 
         if DEBUG:
-            self._printVideoFeed(self._current_feed)
-        return self._createMediaEntries()
+            self._printVideoFeed(feed)
+        return self._createMediaEntries(feed)
 
     def authenticate(self):
         pass
 
-    def _createMediaEntries(self):
+    def _createMediaEntries(self, feed):
         _entries = []
-        for _entry in self._current_feed.entry:
+        for _entry in feed.entry:
             _mediaEntry = MediaEntry(_entry.media.player.url,
                                      [thumb.url for thumb in _entry.media.thumbnail],
                                      _entry.media.title.text,
@@ -74,9 +75,6 @@ class YouTubeService(ServiceInterface):
         for entry in feed.entry:
             self._printEntryDetails(entry)
 
-    def _get_url_from_infos(self, infos):
-        return infos["entries"][0]
-
 #Basic unit tests, will need some assertions :)
 
 if __name__=="__main__":